@@ -8,15 +8,22 @@
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 
+import errno
 import os
 import os.path
+import re
+import select
+import shlex
 import shutil
 import stat
 import tempfile
 import threading
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime
-from stat import S_ISDIR
+from functools import lru_cache
 from subprocess import CalledProcessError
 
 from solidlibs.os.command import run
@@ -26,11 +33,33 @@ from solidlibs.python.utils import is_string
 
 log = Log()
 
-empty_dir = None
+SYS_BLOCK_DIR = '/sys/block'
+
+# mounts() caches the mount table until the kernel says it changed
+# /proc/self/mounts is pollable, but a plain /etc/mtab file is not
+MOUNTS_PATH = '/proc/self/mounts'
+mounts_file = None
+mounts_poll = None
+mounts_cache = None
+# (pid, mount namespace) that opened mounts_file
+mounts_owner = None
+mounts_lock = threading.Lock()
 
 DEFAULT_PERMISSIONS_DIR_OCTAL = 0o755
 DEFAULT_PERMISSIONS_FILE_OCTAL = 0o640
 
+# bytes per copy_file_range(), sendfile(), or read() when copying file data
+COPY_BLOCKSIZE = 1024 * 1024
+
+# threads that copy files when copy() walks a tree itself
+COPY_THREADS = 2 * (os.cpu_count() or 1)
+
+# buffer size for reading and writing when edit_file_in_place() streams a file
+EDIT_BUFFER_SIZE = 64 * 1024
+
+# paths per chmod/chown/chgrp command when a recursive change runs in parallel
+RECURSIVE_BATCH_SIZE = 1000
+
 # use strings with chmod command, run('chmod'), and solidlibs.os.fs.chmod()
 DEFAULT_PERMISSIONS_DIR = 'u=rwX,g=rX,o=rX'
 DEFAULT_PERMISSIONS_FILE = 'u=rw,g=r,o='
@@ -102,70 +131,96 @@ def chmod(mode, path, recursive=False):
     # after we remove this assert, mode can be a string
     assert is_string(path)
 
-    if isinstance(mode, int):
-        # chmod wants an octal int, not decimal
-        # so if it's an int we convert to an octal string
-        oct_mode = oct(mode)
-        if 'o' in oct_mode:
-            i = oct_mode.find('o')
-            oct_mode = oct_mode[i+1:]
-
-        if len(oct_mode) > 4 and not oct_mode.startswith('0'):
-            mode = '0' + oct_mode
-        else:
-            mode = oct_mode
-
     try:
         if recursive:
-            run(*['chmod', '--recursive', mode, path])
+            _run_recursive(['chmod', _mode_to_str(mode)], path, skip_links=True)
         else:
-            run(*['chmod', mode, path])
-    except CalledProcessError as cpe:
+            octal_mode = _octal_mode(mode)
+            if octal_mode is None:
+                # symbolic modes such as 'u=rwX,g=rX,o=rX' need the chmod command
+                run(*['chmod', mode, path])
+            else:
+                os.chmod(path, octal_mode)
+    except (CalledProcessError, OSError) as err:
         log.error(f'unable to chmod: path={path}, mode={mode}')
-        log.error(cpe)
+        log.error(err)
         raise
 
+@lru_cache(maxsize=256)
+def _mode_to_str(mode):
+    ''' Return mode as a string for the chmod command.
+
+        Cached because copy() and merge() use the same few modes over and over.
+
+        >>> _mode_to_str(0o755)
+        '0755'
+        >>> _mode_to_str('u=rwX,g=rX,o=rX')
+        'u=rwX,g=rX,o=rX'
+    '''
+
+    if isinstance(mode, int):
+        # chmod wants an octal int, not decimal
+        # so if it's an int we convert to an octal string
+        mode = f'0{mode:o}'
+
+    return mode
+
+@lru_cache(maxsize=256)
+def _octal_mode(mode):
+    ''' Return mode as an int for os.chmod(), or None if mode is symbolic.
+
+        >>> oct(_octal_mode(0o640))
+        '0o640'
+        >>> oct(_octal_mode('0640'))
+        '0o640'
+        >>> _octal_mode('u=rw,g=r,o=') is None
+        True
+    '''
+
+    if isinstance(mode, int):
+        octal_mode = mode
+    else:
+        try:
+            octal_mode = int(mode, 8)
+        except ValueError:
+            octal_mode = None
+
+    return octal_mode
+
 def chown(owner, path, recursive=False):
     ''' Change owner of path.
 
         'owner' can be the user name, uid as an int, or uid as a string.
 
         Log and reraise any exception.
+
+        >>> fd, filename = tempfile.mkstemp()
+        >>> os.close(fd)
+        >>> chown(str(os.geteuid()), filename)
+        >>> assert getuid(filename) == os.geteuid()
+        >>> os.remove(filename)
     '''
 
     try:
+        if type(owner) is str and ':' in owner:
+            user, group = owner.split(':')
+        else:
+            user, group = owner, None
+        uid = _resolve_uid(user)
+        gid = _resolve_gid(group)
+
         if recursive:
-            run(*['chown', '--recursive', owner, path])
+            _run_recursive(['chown', '--no-dereference', owner], path)
         else:
-            run(*['chown', owner, path])
+            os.chown(path, uid, -1 if gid is None else gid)
         #log.debug(f'chown(owner={owner}, path=={path})')
-    except CalledProcessError as cpe:
+    except (CalledProcessError, OSError, KeyError) as err:
         log.error(f'unable to chown: user={whoami()}, owner={owner}, path={path}')
-        log.error(cpe)
+        log.error(err)
         raise
 
     # verify. after we have higher confidence, move this into doctests
-    if type(owner) is str and ':' in owner:
-        owner, group = owner.split(':')
-    else:
-        group = None
-    try:
-        uid = int(owner)
-    except ValueError:
-        # import delayed to avoid infinite recursion
-        from solidlibs.os.user import getuid
-
-        uid = getuid(owner)
-    assert getuid(path) == uid, f'uid set to {uid} but is {getuid(path)}'
-    if group is not None:
-        try:
-            gid = int(group)
-        except ValueError:
-            # import delayed to avoid infinite recursion
-            from solidlibs.os.user import getuid
-
-            gid = getgid(group)
-        assert getgid(path) == gid, f'gid set to {gid} but is {getgid(path)}'
+    _verify_owner(path, uid, gid, follow_symlinks=not recursive)
 
 def chgrp(group, path, recursive=False):
     ''' Change group of path.
@@ -176,38 +231,113 @@ def chgrp(group, path, recursive=False):
     '''
 
     try:
+        if type(group) is str and ':' in group:
+            user, group_name = group.split(':')
+        else:
+            user, group_name = None, group
+        uid = _resolve_uid(user)
+        gid = _resolve_gid(group_name)
+
         if recursive:
-            run(*['chgrp', '--recursive', group, path])
+            _run_recursive(['chgrp', '--no-dereference', group], path)
         else:
-            run(*['chgrp', group, path])
+            os.chown(path, -1 if uid is None else uid, gid)
         #log.debug(f'chgrp(group={group}, path=={path})')
-    except CalledProcessError as cpe:
+    except (CalledProcessError, OSError, KeyError) as err:
         log.error(f'unable to chgrp: user={whoami()}, group={group}, path={path}')
-        log.error(cpe)
+        log.error(err)
         raise
 
     # verify. after we have higher confidence, move this into doctests
-    if type(group) is str and ':' in group:
-        owner, group = group.split(':')
+    _verify_owner(path, uid, gid, follow_symlinks=not recursive)
+
+def _run_recursive(command_args, path, skip_links=False):
+    ''' Run a command such as chmod on path and everything under it.
+
+        'command_args' are the command and its args without the path,
+        e.g. ['chown', '--no-dereference', 'root'].
+
+        For a dir, find lists the tree and xargs runs the command on
+        batches of paths in parallel on all cpus. If skip_links=True,
+        symlinks in the tree are not passed to the command. This matches
+        chmod --recursive, which ignores symlinks it finds.
+
+        Otherwise this is just the command with --recursive.
+    '''
+
+    command_args = list(map(str, command_args))
+    cpus = os.cpu_count() or 1
+    if cpus > 1 and os.path.isdir(path) and not os.path.islink(path):
+        find_args = ['find', path]
+        if skip_links:
+            find_args.extend(['!', '-type', 'l'])
+        pipeline = (
+            f'{shlex.join(find_args)} -print0 | ' +
+            f'xargs --null --no-run-if-empty --max-args={RECURSIVE_BATCH_SIZE} --max-procs={cpus} ' +
+            f'{shlex.join(command_args)} --')
+        run(pipeline, shell=True, glob=False)
+    else:
+        run(*([command_args[0], '--recursive'] + command_args[1:] + [path]))
+
+def _resolve_uid(owner):
+    ''' Return uid for an owner name, uid as an int, or uid as a string.
+
+        Return None if owner is None.
+
+        Names are looked up with solidlibs.os.user.getuid(), which caches
+        them. See solidlibs.os.user.clear_user_caches().
+    '''
+
+    if owner is None:
+        uid = None
     else:
-        owner = None
-    if owner is not None:
         try:
             uid = int(owner)
         except ValueError:
             # import delayed to avoid infinite recursion
-            from solidlibs.os.user import getuid
+            from solidlibs.os.user import getuid as getuid_from_name
 
-            uid = getuid(owner)
-        assert getuid(path) == uid, f'uid set to {uid} but is {getuid(path)}'
-    try:
-        gid = int(group)
-    except ValueError:
-        # import delayed to avoid infinite recursion
-        from solidlibs.os.user import getuid
+            uid = getuid_from_name(owner)
+
+    return uid
+
+def _resolve_gid(group):
+    ''' Return gid for a group name, gid as an int, or gid as a string.
+
+        Return None if group is None.
+
+        Names are looked up with solidlibs.os.user.getgid(), which caches
+        them, like _resolve_uid().
+    '''
+
+    if group is None:
+        gid = None
+    else:
+        try:
+            gid = int(group)
+        except ValueError:
+            # import delayed to avoid infinite recursion
+            from solidlibs.os.user import getgid as getgid_from_name
+
+            gid = getgid_from_name(group)
+
+    return gid
+
+def _verify_owner(path, expected_uid=None, expected_gid=None, follow_symlinks=True):
+    ''' Assert path has the expected uid and gid.
+
+        Uses a single stat for both checks. None means don't check.
+
+        A plain chown follows a symlink to its target. A recursive
+        chown uses --no-dereference and changes the symlink itself, so
+        check that with follow_symlinks=False.
+    '''
 
-        gid = getgid(group)
-    assert getgid(path) == gid, f'gid set to {gid} but is {getgid(path)}'
+    statinfo = os.stat(path, follow_symlinks=follow_symlinks)
+    if expected_uid is not None:
+        assert statinfo.st_uid == expected_uid, f'uid set to {expected_uid} but is {statinfo.st_uid}'
+    if expected_gid is not None:
+        assert statinfo.st_gid == expected_gid, f'gid set to {expected_gid} but is {statinfo.st_gid}'
 
 def getmode(path):
     ''' Return permissions (mode) of a path.
@@ -231,13 +361,145 @@ def getgid(path):
 def set_attributes(path, owner=None, group=None, perms=None, recursive=False):
     ''' Set ownership and permissions. '''
 
-    if owner is not None:
-        chown(owner, path, recursive)
-    if group is not None:
-        chgrp(group, path, recursive)
+    if owner is not None and group is not None and ':' not in str(owner):
+        # one chown sets both
+        chown(f'{owner}:{group}', path, recursive)
+    else:
+        if owner is not None:
+            chown(owner, path, recursive)
+        if group is not None:
+            chgrp(group, path, recursive)
     if perms is not None:
         chmod(perms, path, recursive)
 
+def _set_attributes_fd(fd, owner=None, group=None, perms=None):
+    ''' Set ownership and permissions of an open file.
+
+        Like set_attributes(), but fchown() and fchmod() use the fd
+        instead of looking up the path again. 'perms' must be an int.
+    '''
+
+    if type(owner) is str and ':' in owner:
+        owner, owner_group = owner.split(':')
+        if group is None:
+            group = owner_group
+
+    uid = _resolve_uid(owner)
+    gid = _resolve_gid(group)
+    if uid is not None or gid is not None:
+        os.fchown(fd,
+                  -1 if uid is None else uid,
+                  -1 if gid is None else gid)
+
+    if perms is not None:
+        os.fchmod(fd, perms)
+
+def _copy_file(source, dest, owner=None, group=None, perms=None, preserve_owner=False):
+    ''' Copy a single file's data, mode, and timestamps.
+
+        If preserve_owner=True, also copy ownership if we can,
+        like 'cp --preserve'.
+
+        Ownership and permissions from keywords are set on the open
+        dest file. Symbolic perms such as 'u=rw,g=r,o=' are set with
+        chmod() after the file is closed.
+
+        chown clears setuid and setgid, so the mode is set after the
+        owner. Special bits survive a copy with a new owner.
+
+        >>> testdir = tempfile.mkdtemp()
+        >>> source = os.path.join(testdir, 'source')
+        >>> dest = os.path.join(testdir, 'dest')
+        >>> with open(source, 'w') as f:
+        ...     __ = f.write('#!/bin/sh\\n')
+        >>> os.chmod(source, 0o4755)
+        >>> _copy_file(source, dest, owner=os.geteuid())
+        >>> oct(stat.S_IMODE(os.stat(dest).st_mode))
+        '0o4755'
+        >>> shutil.rmtree(testdir)
+    '''
+
+    # fchmod() needs a numeric mode
+    fd_perms = None if perms is None else _octal_mode(perms)
+
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        statinfo = os.fstat(source_fd)
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, stat.S_IMODE(statinfo.st_mode))
+        try:
+            _copy_data(source_fd, dest_fd)
+
+            if preserve_owner:
+                try:
+                    os.fchown(dest_fd, statinfo.st_uid, statinfo.st_gid)
+                except PermissionError:
+                    pass
+
+            # the new file's mode was masked by umask, and an existing file kept its old mode
+            if fd_perms is None:
+                fd_perms = stat.S_IMODE(statinfo.st_mode)
+            # chown first, because it clears setuid and setgid
+            _set_attributes_fd(dest_fd, owner=owner, group=group, perms=fd_perms)
+            os.utime(dest_fd, ns=(statinfo.st_atime_ns, statinfo.st_mtime_ns))
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(source_fd)
+
+    if perms is not None and fd_perms is None:
+        chmod(perms, dest)
+
+def _copy_data(source_fd, dest_fd):
+    ''' Copy data from source_fd's current position to dest_fd.
+
+        Tries copy_file_range(), then sendfile(), then read() and write().
+        copy_file_range() keeps the data in the kernel, and on some
+        filesystems just shares the blocks. Each way uses and updates
+        the file positions, so a fallback picks up where the last one
+        stopped.
+
+        procfs, sysfs, and some FUSE and network filesystems report 0
+        bytes copied for files that aren't empty. So if a way copies
+        nothing at all, we try the next way. read() is always right.
+
+        >>> with open('/proc/self/status', 'rb') as source:
+        ...     with tempfile.TemporaryFile() as dest:
+        ...         _copy_data(source.fileno(), dest.fileno())
+        ...         dest.tell() > 0
+        True
+    '''
+
+    try:
+        if os.copy_file_range(source_fd, dest_fd, COPY_BLOCKSIZE):
+            while os.copy_file_range(source_fd, dest_fd, COPY_BLOCKSIZE):
+                pass
+            return
+    except (AttributeError, OSError) as err:
+        # not available on this os, or these files can't use it
+        if not _is_copy_fallback_error(err):
+            raise
+
+    try:
+        if os.sendfile(dest_fd, source_fd, None, COPY_BLOCKSIZE):
+            while os.sendfile(dest_fd, source_fd, None, COPY_BLOCKSIZE):
+                pass
+            return
+    except (AttributeError, OSError) as err:
+        if not _is_copy_fallback_error(err):
+            raise
+
+    while True:
+        data = os.read(source_fd, COPY_BLOCKSIZE)
+        if not data:
+            break
+        os.write(dest_fd, data)
+
+def _is_copy_fallback_error(err):
+    ''' Return True if _copy_data() should try a more basic way to copy. '''
+
+    return (isinstance(err, AttributeError) or
+            err.errno in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL))
+
 def makedir(dirname, owner=None, group=None, perms=None):
     ''' Make dir with default ownership and permissions.
 
@@ -251,26 +513,20 @@ def makedir(dirname, owner=None, group=None, perms=None):
     if perms is None:
         perms = DEFAULT_PERMISSIONS_DIR
 
-    lock = threading.Lock()
-    lock.acquire(1) # 1 means blocking
-
+    # makedirs(dirname, mode) uses umask, so we also call chmod() explicitly
+    #log.debug(f'makedir(dirname={dirname}, owner={owner}, group={group}, perms={oct(perms)})') #DEBUG
     try:
-        if not os.path.exists(dirname):
-
-            # makedirs(dirname, mode) uses umask, so we also call chmod() explicitly
-            #log.debug(f'makedir(dirname={dirname}, owner={owner}, group={group}, perms={oct(perms)})') #DEBUG
-            try:
-                os.makedirs(dirname)
-            except OSError:
-                log.error(why_file_permission_denied(dirname, perms))
-                raise
-            else:
-                set_attributes(dirname, owner, group, perms, recursive=True)
-
-    finally:
-        lock.release()
-
-    assert os.path.isdir(dirname), f'could not make dir: {dirname}'
+        os.makedirs(dirname)
+    except FileExistsError:
+        # no exists() check first, so no race with another thread or process
+        # makedirs() also raises FileExistsError if dirname is a file
+        assert os.path.isdir(dirname), f'could not make dir: {dirname}'
+    except OSError:
+        log.error(why_file_permission_denied(dirname, perms))
+        raise
+    else:
+        # the new dir is empty, so no need for a recursive change
+        set_attributes(dirname, owner, group, perms)
 
 @contextmanager
 def temp_mount(*args, **kwargs):
@@ -329,20 +585,54 @@ def mounts():
         List elements are (device, mountpoint, vfstype, options).
         All elements are strings.
 
+        The mount table is cached until the kernel reports that
+        something was mounted or unmounted. After a fork or a change
+        of mount namespace, the mounts file is reopened and the cache
+        dropped, because the old file is shared with the parent or
+        reports on the old namespace.
+
         >>> if whoami == 'root':
         ...     m = mounts()
         ...     for knownmount in ['/', '/sys', '/proc', '/dev']:
         ...         assert any(knownmount == mountpoint for (device, mountpoint, vfstype, options) in m)
     '''
 
-    results = []
-    with sudo():
-        with open('/etc/mtab') as mtab:
-            for line in mtab:
+    global mounts_file, mounts_poll, mounts_cache, mounts_owner
+
+    with mounts_lock:
+        owner = (os.getpid(), _mount_namespace())
+        if mounts_file is not None and owner != mounts_owner:
+            mounts_file.close()
+            mounts_file = None
+            mounts_cache = None
+
+        if mounts_file is None:
+            with sudo():
+                mounts_file = open(MOUNTS_PATH)
+            mounts_poll = select.poll()
+            mounts_poll.register(mounts_file, select.POLLPRI | select.POLLERR)
+            mounts_owner = owner
+
+        # the kernel flags the open mounts file when anything is mounted or unmounted
+        if mounts_cache is None or mounts_poll.poll(0):
+            results = []
+            mounts_file.seek(0)
+            for line in mounts_file:
                 device, mountpoint, vfstype, options, dump, fsck = tuple(line.split())
                 results.append((device, mountpoint, vfstype, options))
+            mounts_cache = results
+
+        return list(mounts_cache)
 
-    return results
+def _mount_namespace():
+    ''' Return an id for our mount namespace, or None if unknown. '''
+
+    try:
+        namespace = os.readlink('/proc/self/ns/mnt')
+    except OSError:
+        namespace = None
+
+    return namespace
 
 def mounted_devices():
     ''' Return list of mounted devices. '''
@@ -355,13 +645,13 @@ def unmounted_block_devices():
         i.e. unmounted block devices. '''
 
     unmounted = []
-    mounted = mounted_devices()
+    # in sorted order, every mounted device that starts with a prefix
+    # is at or right after the prefix's insertion point
+    mounted = sorted(mounted_devices())
     for device in devices():
         # /dev/sda may appear to not be mounted, but /dev/sda1 is
-        dev_mounted = False
-        for mounted_device in mounted:
-            if mounted_device.startswith(device):
-                dev_mounted = True
+        i = bisect_left(mounted, device)
+        dev_mounted = i < len(mounted) and mounted[i].startswith(device)
         if not dev_mounted:
             unmounted.append(device)
 
@@ -400,27 +690,45 @@ def unmount_all(dirname, force=False):
     # make sure we have a trailing slash
     dir_prefix = os.path.join(dirname, '')
 
+    # count mounts once instead of checking the mount table for every mountpoint
+    # a count, not a set, because more than one filesystem can be mounted on a path
+    all_mounts = mounts()
+    mountpoint_counts = Counter(mountpoint for device, mountpoint, vfstype, options in all_mounts)
+
     # umount last mounted first, dirname last
     try:
-        for device, mountpoint, vfstype, options in reversed(mounts()):
+        for device, mountpoint, vfstype, options in reversed(all_mounts):
             if mountpoint.startswith(dir_prefix):
-                unmount(mountpoint, force=force)
+                unmount(mountpoint, force=force, mountpoint_counts=mountpoint_counts)
     except FileSystemException:
         # still try umount at the top level dir
         pass
 
-    unmount(dirname)
+    unmount(dirname, mountpoint_counts=mountpoint_counts)
 
-def unmount(mountpoint, force=False):
+def unmount(mountpoint, force=False, mountpoint_counts=None):
     ''' Unmount mountpoint.
 
-        If force=True, unmount even if mounts are in use.'''
+        If force=True, unmount even if mounts are in use.
+
+        'mountpoint_counts' is a Counter of mountpoints from unmount_all().
+        If present, it is used instead of the mount table and updated
+        after a successful unmount. If the first umount fails, the count
+        is taken from the mount table again.
+    '''
 
-    if mounted(mountpoint):
+    if mountpoint_counts is None:
+        is_mounted = mounted(mountpoint)
+    else:
+        is_mounted = mountpoint_counts[mountpoint.rstrip('/')] > 0
+
+    if is_mounted:
         log.debug(f'unmount {mountpoint}')
 
         try:
             run(*['umount', mountpoint])
+            if mountpoint_counts is not None:
+                mountpoint_counts[mountpoint.rstrip('/')] -= 1
 
         except Exception as exc:
             log.debug(f'error in first attempt to unmount: {mountpoint}')
@@ -430,11 +738,11 @@ def unmount(mountpoint, force=False):
             if mounted(mountpoint):
 
                 # import delayed to avoid import recursion
-                import solidlibs.python.process
+                import solidlibs.os.process
 
                 # find what process has the path open
                 msg = f'unmount failed: {mountpoint}'
-                programs = solidlibs.python.process.programs_using_file(mountpoint)
+                programs = solidlibs.os.process.programs_using_file(mountpoint)
                 if programs:
                     msg += f', in use by {programs}'
                 log.debug(msg)
@@ -469,31 +777,80 @@ def unmount(mountpoint, force=False):
             else:
                 log.debug(f'umount had error but path is not mounted: {mountpoint}')
 
+            # a lazy or forced umount, or someone else, unmounted it
+            if mountpoint_counts is not None:
+                path = mountpoint.rstrip('/')
+                mountpoint_counts[path] = mountpoints().count(path)
+
 def mounted(path):
     ''' Return True iff path mounted. '''
 
     return path.rstrip('/') in mountpoints()
 
 def mounted_on(path):
-    ''' Return device mounted on path, or None if none. '''
+    ''' Return device mounted on path, or None if none.
 
-    mounted_device = None
-    for device, mountpoint, vfstype, options in mounts():
-        # return first matching device
-        if mounted_device is not None:
-            if path == mountpoint:
-                mounted_device = device
+        >>> mounted_on('/proc')
+        'proc'
+        >>> mounted_on('/proc/')
+        'proc'
+        >>> mounted_on('/not/a/mountpoint') is None
+        True
+    '''
 
-    return mounted_device
+    path = path.rstrip('/') or '/'
+
+    # return first matching device
+    return next((device
+                 for device, mountpoint, vfstype, options in mounts()
+                 if mountpoint == path),
+                None)
 
 def devices():
     ''' Return list of devices that may have filesystems. '''
 
     # block devices may have filesystems
-    raw_output = run(*['lsblk', '--noheadings', '--list', '--paths', '--output=NAME']).stdout.decode()
-    devices = raw_output.strip().split('\n')
+    # like 'lsblk --list --paths', but read sysfs instead of starting a program
+    devices = []
+    with os.scandir(SYS_BLOCK_DIR) as disk_entries:
+        for disk in sorted(disk_entries, key=lambda entry: entry.name):
+            # an empty device, such as an unused loop device, can't have a filesystem
+            if _block_device_size(disk.path) > 0:
+                devices.append(_block_device_path(disk.path, disk.name))
+
+                # partitions are subdirs with a 'partition' file
+                with os.scandir(disk.path) as entries:
+                    for entry in sorted(entries, key=lambda entry: entry.name):
+                        if os.path.exists(os.path.join(entry.path, 'partition')):
+                            devices.append(_block_device_path(entry.path, entry.name))
+
     return devices
 
+def _block_device_size(sys_path):
+    ''' Return size of a block device in 512 byte sectors, or 0 if unknown. '''
+
+    try:
+        with open(os.path.join(sys_path, 'size')) as size_file:
+            size = int(size_file.read())
+    except (OSError, ValueError):
+        size = 0
+
+    return size
+
+def _block_device_path(sys_path, name):
+    ''' Return the /dev path for a block device in sysfs.
+
+        Device mapper devices use their /dev/mapper name, like lsblk.
+    '''
+
+    try:
+        with open(os.path.join(sys_path, 'dm', 'name')) as dm_name_file:
+            path = os.path.join('/dev/mapper', dm_name_file.read().strip())
+    except OSError:
+        path = os.path.join('/dev', name)
+
+    return path
+
 def match_parent_owner(path, mode=None):
     ''' Chown to the parent dir's uid and gid.
 
@@ -516,33 +873,33 @@ def get_unique_filename(dirname, prefix, suffix):
     '''
         Get a unique filename.
 
+        The name includes the prefix, a timestamp, and the suffix.
+        The file is created empty, so no one else gets the same name.
+
         >>> dirname = '/tmp'
         >>> prefix = 'test'
         >>> suffix = 'txt'
         >>> filename = get_unique_filename(dirname, prefix, suffix)
         >>> len(filename) > 0
         True
-        >>> filename = get_unique_filename(dirname, prefix, suffix)
-        >>> len(filename) > 0
+        >>> filename2 = get_unique_filename(dirname, prefix, suffix)
+        >>> filename2 != filename
         True
-        >>> filename = get_unique_filename(dirname, prefix, suffix)
-        >>> len(filename) > 0
+        >>> os.path.basename(filename2).startswith(f'{prefix}-')
+        True
+        >>> filename2.endswith(f'.{suffix}')
         True
+        >>> os.remove(filename)
+        >>> os.remove(filename2)
     '''
 
+    # mkstemp() creates the file with O_EXCL, so no need to probe for existing names
     now = datetime.now()
-    base_filename = '%s-%d-%02d-%02d-%02d-%02d-%02d' % (
-     prefix, now.year, now.month, now.day, now.hour, now.minute, now.second)
-    filename = f'{base_filename}.{suffix}'
+    handle, filename = tempfile.mkstemp(
+        prefix=f'{prefix}-{now:%Y-%m-%d-%H-%M-%S}-', suffix=f'.{suffix}', dir=dirname)
+    os.close(handle)
 
-    if os.path.exists(os.path.join(dirname, filename)):
-        i = 1
-        filename = f'{base_filename}-{i:02d}.{suffix}'
-        while os.path.exists(os.path.join(dirname, filename)):
-            i += 1
-            filename = f'{base_filename}-{i:02d}.{suffix}'
-
-    return os.path.join(dirname, filename)
+    return filename
 
 def copy(source, dest, symlinks=True, ignore=None, owner=None, group=None, perms=None):
     ''' Copy source to dest dir.
@@ -608,11 +965,15 @@ def copy(source, dest, symlinks=True, ignore=None, owner=None, group=None, perms
     # log.debug('copy(source={}, dest={}, symlinks=={}, ignore=={}, owner=={}, group=={}, perms=={})'.
     #    format(source, dest, symlinks, ignore, owner, group, perms))
 
+    # one lstat per source answers "exists", "is link", and usually "is dir"
     # source must exist, but a dangling link is acceptable
-    if not os.path.exists(source) and not os.path.islink(source):
+    try:
+        source_mode = os.lstat(source).st_mode
+    except FileNotFoundError:
         raise ValueError(f'source "{source}" does not exist')
+    source_is_link = stat.S_ISLNK(source_mode)
 
-    if symlinks and os.path.islink(source):
+    if symlinks and source_is_link:
         dest = os.path.join(dest, os.path.basename(source))
         if os.path.exists(dest):
             # log.debug(f'copy() source is link but dest exists, remove dest: {dest}')
@@ -630,11 +991,15 @@ def copy(source, dest, symlinks=True, ignore=None, owner=None, group=None, perms
                     dest = os.path.join(dest, os.path.basename(source))
                     log.debug(f'copy() set path to include source basename: {dest}')
 
-        if os.path.exists(dest):
-            log.debug(f'copy() remove dest: {dest}')
-            run(*['rm', dest, '--force', '--recursive'])
+        _ensure_absent(dest)
+
+        if source_is_link:
+            # symlinks=False, so follow the link
+            source_is_dir = os.path.isdir(source)
+        else:
+            source_is_dir = stat.S_ISDIR(source_mode)
 
-        if os.path.isdir(source):
+        if source_is_dir:
 
             unmount_all(source)
 
@@ -645,32 +1010,82 @@ def copy(source, dest, symlinks=True, ignore=None, owner=None, group=None, perms
 
             else:
                 # log.debug(f'copy(..., symlinks={symlinks}, ignore={ignore})')
-                makedir(dest)
-                # copystat does *not* affect owner and group
-                shutil.copystat(source, dest)
-                set_attributes(dest, owner=owner, group=group, recursive=True)
-
-                files = os.listdir(source)
-                if ignore is None:
-                    ignored = []
+                _copy_tree(source, dest, symlinks=symlinks, ignore=ignore, owner=owner, group=group, perms=perms)
+
+        else:
+            # like 'cp --preserve', keep mode, timestamps, and ownership if we can
+            _copy_file(source, dest, owner=owner, group=group, perms=perms, preserve_owner=True)
+
+    # no stats here just to log; they cost syscalls and fail on a dangling symlink
+    log.debug(f'after copy: dest={dest}, owner={owner}, group={group}, perms={perms}')
+
+def _copy_tree(source, dest, symlinks=True, ignore=None, owner=None, group=None, perms=None):
+    ''' Copy the dir tree at source to a new dest for copy().
+
+        Dirs are walked breadth first in this thread. Files are copied
+        by a pool of threads, which spend most of their time in system
+        calls that release the GIL.
+
+        'ignore' is called like shutil.copytree()'s ignore. It may
+        return names or full source paths.
+
+        Like copy(), dirs get owner and group but not perms.
+    '''
+
+    dirs = deque([(source, dest)])
+    file_copies = []
+    with ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+        while dirs:
+            source_dir, dest_dir = dirs.popleft()
+
+            unmount_all(source_dir)
+            # copystat() sets the mode, so no need for makedir()'s chmod
+            os.makedirs(dest_dir, exist_ok=True)
+            # copystat does *not* affect owner and group
+            shutil.copystat(source_dir, dest_dir)
+            # the dir is still empty
+            set_attributes(dest_dir, owner=owner, group=group)
+
+            with os.scandir(source_dir) as source_entries:
+                entries = list(source_entries)
+            if ignore is None:
+                ignored = set()
+            else:
+                ignored = ignore(source_dir, [entry.name for entry in entries])
+                # log.debug(f'copy() ignored set to {ignored}')
+
+            for entry in entries:
+                if entry.name in ignored or entry.path in ignored:
+                    continue
+
+                dest_path = os.path.join(dest_dir, entry.name)
+                if symlinks and entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), dest_path)
+                elif entry.is_dir():
+                    dirs.append((entry.path, dest_path))
                 else:
-                    ignored = ignore(source, files)
-                    # log.debug(f'copy() ignored set to {ignored}')
+                    # like 'cp --preserve', keep mode, timestamps, and ownership if we can
+                    file_copies.append(executor.submit(
+                        _copy_file, entry.path, dest_path,
+                        owner=owner, group=group, perms=perms, preserve_owner=True))
 
-                for file in files:
+        # raise the first error, if any
+        for file_copy in file_copies:
+            file_copy.result()
 
-                    source_path = os.path.join(source, file)
-                    if source_path not in ignored:
-                        # log.debug('copy() recursing')
-                        copy(source_path, dest,
-                             symlinks=symlinks, ignore=ignore, owner=owner, group=group, perms=perms)
+def _ensure_absent(path):
+    ''' Remove path, whatever it is, if it exists.
 
-        else:
-            run(*['cp', source, dest, '--preserve'])
-            set_attributes(dest, owner, group, perms, recursive=True)
+        Just try to remove it. Checking whether it exists first costs
+        another stat, and the answer can change before we act on it.
+    '''
 
-    log.debug('after copy: dest={}, owner=={}, group=={}, perms=={})'. # DEBUG
-        format(dest, getuid(dest), getgid(dest), oct(getmode(dest)))) # DEBUG
+    try:
+        os.unlink(path)
+    except IsADirectoryError:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
 
 def copy_only(source, dest):
     ''' Copy 'source' to 'dest'.
@@ -720,30 +1135,33 @@ def merge(source, dest, symlinks=True, force=True, ignore=None, owner=None, grou
     # log.debug('merge(source={}, dest={}, symlinks=={}, force=={}, ignore=={}, owner=={}, group=={}, perms=={})'.
     #     format(source, dest, symlinks, force, ignore, owner, group, perms))
 
-    names = os.listdir(source)
+    # DirEntry caches file type and stat info, so we don't stat each path again
+    with os.scandir(source) as source_entries:
+        entries = list(source_entries)
     if ignore is not None:
-        ignored_names = ignore(source, names)
+        ignored_names = ignore(source, [entry.name for entry in entries])
     else:
         ignored_names = set()
 
     errors = []
 
-    for name in names:
+    for entry in entries:
+        name = entry.name
         if name not in ignored_names:
 
-            sourcename = os.path.join(source, name)
+            sourcename = entry.path
             destname = os.path.join(dest, name)
 
             try:
-                if symlinks and os.path.islink(sourcename):
+                if symlinks and entry.is_symlink():
                     linkto = os.readlink(sourcename)
                     # log.debug(f'merge() symlink({linkto}, {destname})') #DEBUG
                     remove_dest(destname)
                     os.symlink(linkto, destname)
 
-                elif os.path.isdir(sourcename):
+                elif entry.is_dir():
                     if not os.path.isdir(destname):
-                        mode = getmode(sourcename)
+                        mode = stat.S_IMODE(entry.stat(follow_symlinks=False).st_mode)
                         # log.debug(f'merge() makedirs({destname}, {mode})') #DEBUG
                         makedir(destname, perms=mode)
                     merge(sourcename, destname,
@@ -753,12 +1171,8 @@ def merge(source, dest, symlinks=True, force=True, ignore=None, owner=None, grou
                 else:
                     # log.debug(f'merge() copy2({sourcename}, {destname})') #DEBUG
                     remove_dest(destname)
-                    shutil.copy2(sourcename, destname)
-                    set_attributes(destname, owner=owner, group=group, recursive=True)
-
-                    mode = perms or getmode(sourcename)
-                    #log.debug(f'  src mode: {oct(getmode(sourcename))}') #DEBUG
-                    chmod(mode, destname)
+                    # without perms, _copy_file() copies the source's mode
+                    _copy_file(sourcename, destname, owner=owner, group=group, perms=perms)
                 # XXX What about devices, sockets etc.?
 
             except (IOError, os.error) as why:
@@ -832,7 +1246,19 @@ def move(source, dest, owner=None, group=None, perms=None):
     parent_dir = os.path.dirname(dest)
     if not os.path.exists(parent_dir):
         makedir(parent_dir, owner=owner, group=None, perms=None)
-    run(*['mv', '--force', source, dest])
+
+    if os.path.isdir(dest):
+        target = os.path.join(dest, os.path.basename(source))
+    else:
+        target = dest
+    try:
+        os.rename(source, target)
+    except OSError as ose:
+        if ose.errno == errno.EXDEV:
+            # os.rename() can't move across filesystems
+            shutil.move(source, target)
+        else:
+            raise
     set_attributes(dest, owner, group, perms, recursive=True)
 
 def clonedirs(sourceroot, destroot, destdir, owner=None, group=None, perms=None):
@@ -892,56 +1318,123 @@ def clonedirs(sourceroot, destroot, destdir, owner=None, group=None, perms=None)
     else:
         log.debug(f'   owner={owner}, group={group}, perms={perms}')
 
-    # a chroot might have active mounts
-    unmount_all(sourcepath)
+    # walk up from destdir to the nearest dir that already exists
+    missing_dirs = []
+    level = destdir
+    dest_mode = None
+    while dest_mode is None:
+        try:
+            dest_mode = os.stat(os.path.join(destroot, level)).st_mode
+        except (FileNotFoundError, NotADirectoryError):
+            if not level:
+                raise
+            missing_dirs.append(level)
+            level = os.path.dirname(level)
 
-    if os.path.exists(destpath):
-        # if it's a dir, we're done
-        if os.path.isfile(destpath):
-            raise ValueError(f'dest dir is not a dir: {destdir}')
+    # if it's a dir, we're done with this level
+    if stat.S_ISREG(dest_mode):
+        raise ValueError(f'dest dir is not a dir: {level}')
 
-    else:
-        # make any needed parent dirs
-        parent = os.path.dirname(destdir)
-        clonedirs(sourceroot, destroot, parent, owner, group, perms)
+    # a chroot might have active mounts
+    unmount_all(os.path.join(sourceroot, level))
 
+    # make any needed dirs, parents first
+    for level in reversed(missing_dirs):
+        level_sourcepath = os.path.join(sourceroot, level)
         if perms is None:
-            perms = getmode(sourcepath)
-        makedir(destpath, owner, group, perms)
+            level_perms = getmode(level_sourcepath)
+        else:
+            level_perms = perms
+        makedir(os.path.join(destroot, level), owner, group, level_perms)
 
 def remove(path):
     ''' Remove the path.
 
-        If path is a dir, empty it first by rsyncing an empty dir to the
-        path. With a large directory this is much faster than rm or
-        shutil.rmtree().
+        If path is a dir, remove it and everything in it.
 
         It is not an error if the path does not exist.
 
         If path is a link, only remove the link, not the target.
 
         If path is a mount, raise ValueError.
-    '''
 
-    global empty_dir
+        >>> testdir = tempfile.mkdtemp()
+        >>> makedir(os.path.join(testdir, 'subdir'))
+        >>> with open(os.path.join(testdir, 'subdir', 'file'), 'w') as testfile:
+        ...     testfile.write('data')
+        4
+        >>> os.symlink('subdir', os.path.join(testdir, 'link'))
+        >>> remove(os.path.join(testdir, 'link'))
+        >>> os.path.isdir(os.path.join(testdir, 'subdir'))
+        True
+        >>> remove(testdir)
+        >>> os.path.exists(testdir)
+        False
+        >>> remove(testdir)
+    '''
 
-    if os.path.exists(path):
+    # lstat() so we also remove a dangling link, and only the link
+    try:
+        statinfo = os.lstat(path)
+    except FileNotFoundError:
+        statinfo = None
 
-        if empty_dir is None:
-            empty_dir = tempfile.mkdtemp(prefix='solidlibs.os.fs.empty.')
+    if statinfo is not None:
 
-        if os.path.ismount(path):
+        if _is_mount(path, statinfo):
             raise ValueError(f'path is mount point: {path}')
 
-        if os.path.islink(path) or os.path.isfile(path):
-            run(*['rm', '--force', path])
+        if not stat.S_ISDIR(statinfo.st_mode):
+            os.unlink(path)
 
         else:
-            assert os.path.isdir(path)
+            shutil.rmtree(path)
 
-            run(*['rm', '--force', '--recursive', path])
+def _is_mount(path, statinfo):
+    ''' Return True if path is a mount point, as os.path.ismount(),
+        given the lstat() of path.
 
-    assert not os.path.exists(path), f'could not remove {path}'
+        >>> _is_mount('/', os.lstat('/'))
+        True
+        >>> _is_mount('/tmp/..', os.lstat('/'))
+        True
+
+        A file in a symlinked dir on another filesystem is not a mount point.
+
+        >>> from tempfile import mkdtemp
+        >>> target_dir = mkdtemp(dir='/dev/shm')
+        >>> link = os.path.join(mkdtemp(), 'shmlink')
+        >>> os.symlink(target_dir, link)
+        >>> path = os.path.join(link, 'victim')
+        >>> with open(path, 'w') as victim:
+        ...     __ = victim.write('data')
+        >>> _is_mount(path, os.lstat(path)) == os.path.ismount(path) == False
+        True
+        >>> remove(path)
+        >>> os.path.exists(path)
+        False
+        >>> os.remove(link)
+        >>> os.rmdir(os.path.dirname(link))
+        >>> os.rmdir(target_dir)
+    '''
+
+    if stat.S_ISLNK(statinfo.st_mode):
+        is_mount = False
+
+    else:
+        # like posixpath.ismount(), use "..", so a symlinked parent dir
+        # is followed instead of stat-ing the link itself
+        try:
+            parent = os.lstat(os.path.join(path, '..'))
+        except OSError:
+            # e.g. path is not a dir
+            is_mount = False
+        else:
+            # a different device, or the root of the filesystem
+            is_mount = (statinfo.st_dev != parent.st_dev or
+                        statinfo.st_ino == parent.st_ino)
+
+    return is_mount
 
 def relative_path(path):
     ''' Return path as relative path, with no leading or trailing '/'. '''
@@ -951,10 +1444,9 @@ def relative_path(path):
 def filemode(st_mode):
     ''' Convert integer file permissions to an octal string.
 
-        Function named after python 3.3 os.stat.filemode().
-
-        See python - How to convert a stat output to a unix permissions string - Stack Overflow
-            http://stackoverflow.com/questions/17809386/how-to-convert-a-stat-output-to-a-unix-permissions-string
+        Function named after python 3.3 os.stat.filemode(), which
+        does the work. Permissions with no file type are shown
+        as a regular file.
 
         >>> import os, stat, tempfile
 
@@ -968,26 +1460,17 @@ def filemode(st_mode):
         '-rwxrwx---'
 
         >>> os.remove(filename)
+
+        >>> filemode(0o4755)
+        '-rwsr-xr-x'
+        >>> filemode(os.lstat('/').st_mode)
+        'drwxr-xr-x'
     '''
 
-    try:
-        if S_ISDIR(st_mode):
-            is_dir = 'd'
-        else:
-            is_dir = '-'
-    except:   # pylint:bare-except -- catches more than "except Exception"
-        is_dir = '-'
-    octal_to_readable = {
-        '7':'rwx',
-        '6' :'rw-',
-        '5' : 'r-x',
-        '4':'r--',
-        '3':'-wx',
-        '2':'-w-',
-        '1':'--x',
-        '0': '---'}
-    perm = str(oct(st_mode)[-3:])
-    return is_dir + ''.join(octal_to_readable.get(x,x) for x in perm)
+    if not stat.S_IFMT(st_mode):
+        st_mode |= stat.S_IFREG
+
+    return stat.filemode(st_mode)
 
 @contextmanager
 def restore_file(filename):
@@ -997,26 +1480,54 @@ def restore_file(filename):
 
         If the file does not exist on entry and does exists on exit,
         it is deleted.
+
+        >>> f = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        >>> f.write('original')
+        8
+        >>> f.close()
+        >>> with restore_file(f.name):
+        ...     replace_file(f.name, 'changed')
+        >>> with open(f.name) as textfile:
+        ...     textfile.read()
+        'original'
+        >>> os.remove(f.name)
+
+        A symlink is restored as the same symlink.
+
+        >>> link = f.name + '.link'
+        >>> os.symlink('/etc/hostname', link)
+        >>> with restore_file(link):
+        ...     os.remove(link)
+        >>> os.readlink(link)
+        '/etc/hostname'
+        >>> os.remove(link)
     '''
 
     exists = os.path.exists(filename)
 
     if exists:
-        # we just want the pathname, not the handle
-        # tiny chance of race if someone else gets the temp filename
-        handle, backup = tempfile.mkstemp()
-        os.close(handle)
-        run(*['cp', '--archive', filename, backup])
+        # a private temp dir, so the backup name can't already exist
+        backup_dir = tempfile.mkdtemp()
+        backup = os.path.join(backup_dir, os.path.basename(filename))
+        # like 'cp --archive'
+        shutil.copy2(filename, backup, follow_symlinks=False)
+        statinfo = os.lstat(filename)
 
     try:
         yield
 
     finally:
-        if os.path.exists(filename):
-            run(*['rm', filename])
+        if os.path.lexists(filename):
+            os.remove(filename)
         if exists:
             # restore to original state
-            run(*['mv', backup, filename])
+            # shutil.move() renames, or copies if backup is on another filesystem
+            shutil.move(backup, filename)
+            os.rmdir(backup_dir)
+            try:
+                os.chown(filename, statinfo.st_uid, statinfo.st_gid, follow_symlinks=False)
+            except PermissionError:
+                pass
 
 def edit_file_in_place(filename, replacements, regexp=False, lines=False):
     ''' Replace text in file.
@@ -1054,6 +1565,28 @@ def edit_file_in_place(filename, replacements, regexp=False, lines=False):
         ...     newtext = textfile.read()
         >>> assert HOMEPAGE in newtext
 
+        >>> edit_file_in_place(f.name, {'Startpage HTTPS\\n': 'DuckDuckGo\\n'})
+        >>> with open(f.name) as textfile:
+        ...     newtext = textfile.read()
+        >>> 'Startpage' in newtext
+        False
+
+        >>> mtime = os.stat(f.name).st_mtime_ns
+        >>> edit_file_in_place(f.name, {'not in file': 'text'})
+        >>> mtime == os.stat(f.name).st_mtime_ns
+        True
+
+        A file with hard links is edited in place, so every link
+        sees the change.
+
+        >>> link = f.name + '.link'
+        >>> os.link(f.name, link)
+        >>> edit_file_in_place(f.name, {'DuckDuckGo': 'Startpage'}, lines=True)
+        >>> with open(link) as textfile:
+        ...     'Startpage' in textfile.read()
+        True
+        >>> os.remove(link)
+
         >>> os.remove(f.name)
     '''
 
@@ -1069,33 +1602,208 @@ def edit_file_in_place(filename, replacements, regexp=False, lines=False):
         assert is_string(old), f'replacement old "{old}" should be string but is type {type(old)}'
         assert is_string(new), f'replacement new "{new}" should be string but is type {type(new)}'
 
-    # read text
-    mode = os.stat(filename).st_mode
-    with open(filename) as textfile:
-        text = textfile.read()
+    statinfo = os.stat(filename)
 
     if lines:
-        newtext = []
-        for line in text.split('\n'):
+        if regexp:
+            if all(_is_line_pattern(old, new) for old, new in replacements.items()):
+                # the C regex engine can scan many lines in one call
+                flags = re.MULTILINE
+                edit_each_line = False
+            else:
+                flags = 0
+                edit_each_line = True
+            # compile each pattern once instead of once per line
+            compiled_replacements = [(re.compile(old, flags), new) for old, new in replacements.items()]
+        else:
+            edit_each_line = True
+
+        def edit_line(line):
             # sometimes replace_strings() gets a type error
             assert is_string(line), f'line should be string but is {type(line)}'
-            newline = replace_strings(line, replacements, regexp)
-            if not lines_changed:
-                lines_changed = newline != line
-            newtext.append(newline)
-        text = '\n'.join(newtext)
-    else:
-        text = replace_strings(text, replacements, regexp)
-
-    if lines_changed:
-        # write text
-        with open(filename, 'w') as textfile:
-            textfile.write(text)
-        os.chmod(filename, mode)
-        assert mode == os.stat(filename).st_mode
+            if regexp:
+                newline = line
+                for pattern, new in compiled_replacements:
+                    newline = pattern.sub(new, newline)
+            else:
+                newline = replace_strings(line, replacements)
+            return newline
+
+        def edit_lines(text):
+            # a final newline ends the last line, it doesn't start another
+            if text.endswith('\n'):
+                text = text[:-1]
+                ending = '\n'
+            else:
+                ending = ''
+            if edit_each_line:
+                newtext = '\n'.join(edit_line(line) for line in text.split('\n'))
+            else:
+                newtext = edit_line(text)
+            return newtext + ending
+
+        # edit the real file, not a link to it
+        path = os.path.realpath(filename)
+        newfile = _sibling_temp_file(path, buffering=EDIT_BUFFER_SIZE)
+        if newfile is None:
+            with open(path) as textfile:
+                text = textfile.read()
+            newtext = edit_lines(text)
+            lines_changed = newtext != text
+            if lines_changed:
+                _write_in_place(path, newtext)
+
+        else:
+            # stream whole lines to the temp file so we never hold the whole file
+            try:
+                with open(path, buffering=EDIT_BUFFER_SIZE) as textfile, newfile:
+                    text = ''.join(textfile.readlines(EDIT_BUFFER_SIZE))
+                    while text:
+                        newtext = edit_lines(text)
+                        if not lines_changed:
+                            lines_changed = newtext != text
+                        newfile.write(newtext)
+                        text = ''.join(textfile.readlines(EDIT_BUFFER_SIZE))
+
+                if lines_changed and not _replace_with_temp(newfile.name, path, statinfo):
+                    _copy_in_place(newfile.name, path)
+            finally:
+                if os.path.exists(newfile.name):
+                    os.remove(newfile.name)
+
     else:
+        with open(filename) as textfile:
+            text = textfile.read()
+        newtext = replace_strings(text, replacements, regexp)
+        # don't rewrite a file that didn't change
+        lines_changed = newtext != text
+        if lines_changed:
+            _write_in_place(filename, newtext)
+
+    if not lines_changed:
         log.debug('no lines changed')
 
+def _is_line_pattern(pattern, replacement):
+    ''' Return True if replacing the regular expression pattern can
+        never match or make a newline. Then re.MULTILINE replacement
+        in many lines at once gives the same result as replacement in
+        each line.
+
+        The check is conservative. It rejects control characters, negated
+        character classes, extensions such as lookarounds and inline flags,
+        and escapes that can match a newline.
+
+        >>> _is_line_pattern(r'browser\\.startup\\.homepage=.*', r'homepage=\\1')
+        True
+        >>> _is_line_pattern(r'^\\w+ \\d+$', '')
+        True
+        >>> _is_line_pattern(r'a\\s+b', 'a b')
+        False
+        >>> _is_line_pattern(r'[^=]*', 'x')
+        False
+        >>> _is_line_pattern(r'(?s)a.b', 'x')
+        False
+        >>> _is_line_pattern(r'a', r'a\\nb')
+        False
+    '''
+
+    # escapes that can't match a newline
+    line_escapes = 'dwSbB'
+
+    # a double backslash is a literal backslash, not an escape
+    pattern_escapes = re.findall(r'\\(.)', pattern.replace('\\\\', ''))
+    replacement_escapes = re.findall(r'\\(.)', replacement.replace('\\\\', ''))
+
+    return not (
+        any(char < ' ' for char in pattern + replacement) or
+        '[^' in pattern or
+        '(?' in pattern or
+        any(escape.isalpha() and escape not in line_escapes for escape in pattern_escapes) or
+        '0' in pattern_escapes or
+        any(escape.isalpha() and escape != 'g' for escape in replacement_escapes))
+
+def _sibling_temp_file(path, buffering=-1):
+    ''' Return an open text temp file in the same dir as path, for
+        _replace_with_temp(). The caller must remove the temp file if
+        it isn't used.
+
+        Return None if we don't have permission to create files in the dir.
+    '''
+
+    try:
+        temp_file = tempfile.NamedTemporaryFile(
+            mode='w', buffering=buffering, delete=False,
+            dir=os.path.dirname(path), prefix=f'.{os.path.basename(path)}.')
+    except PermissionError:
+        temp_file = None
+
+    return temp_file
+
+def _write_in_place(filename, text):
+    ''' Write text to filename.
+
+        Truncating and writing an existing file keeps its mode and owner.
+    '''
+
+    with open(filename, 'w') as textfile:
+        textfile.write(text)
+
+def _replace_with_temp(temp_path, filename, statinfo):
+    ''' Atomically replace filename with the temp file at temp_path.
+
+        The temp file must be in the same filesystem as filename.
+        It gets the owner, group, mode, and extended attributes such
+        as ACLs of filename. Readers see either the old file or the
+        new one, never a partly written file.
+
+        Return True if filename was replaced. Return False, and leave
+        filename alone, if a new file can't be the same as the old
+        one. That is when filename has hard links, or we can't set
+        its owner or extended attributes. Then the caller should write
+        filename in place.
+    '''
+
+    if statinfo.st_nlink > 1:
+        # a rename would only replace this link
+        replaced = False
+
+    else:
+        try:
+            os.chown(temp_path, statinfo.st_uid, statinfo.st_gid)
+            _copy_xattrs(filename, temp_path)
+        except OSError as ose:
+            log.debug(f'writing {filename} in place: {ose}')
+            replaced = False
+        else:
+            # chmod after chown, which may clear setuid and setgid bits
+            os.chmod(temp_path, stat.S_IMODE(statinfo.st_mode))
+            os.replace(temp_path, filename)
+            replaced = True
+
+    return replaced
+
+def _copy_xattrs(source, dest):
+    ''' Copy extended attributes, including ACLs, from source to dest. '''
+
+    try:
+        names = os.listxattr(source)
+    except OSError as ose:
+        if ose.errno != errno.ENOTSUP:
+            raise
+        names = []
+
+    for name in names:
+        os.setxattr(dest, name, os.getxattr(source, name))
+
+def _copy_in_place(temp_path, filename):
+    ''' Copy the temp file at temp_path into filename.
+
+        Like _write_in_place(), but streams the text from a file.
+    '''
+
+    with open(temp_path, 'rb') as source, open(filename, 'wb') as dest:
+        _copy_data(source.fileno(), dest.fileno())
+
 def why_file_permission_denied(pathname, mode='r'):
     ''' Return string saying why file access didn't work for the current user.
 
@@ -1119,6 +1827,9 @@ def why_file_permission_denied(pathname, mode='r'):
             network filesystems which may have permissions semantics
             beyond the usual POSIX permission-bit model.
 
+        Permissions are checked with one stat per path and the mode bits,
+        so unlike is_readable() etc., ACLs are not checked.
+
         Example::
                 try:
                     os.makedirs(new_dir)
@@ -1126,47 +1837,145 @@ def why_file_permission_denied(pathname, mode='r'):
                     why = why_file_permission_denied(new_dir, mode='ws')
                     log(f"os.makedirs('{new_dir}') failed: {why}")
                     raise
+
+        >>> why_file_permission_denied('/tmp', mode='rwx') is None
+        True
+        >>> why_file_permission_denied('/not/a/dir/file').startswith('no "r" access for /not/a/dir/file')
+        True
     '''
 
     if type(mode) == int:
         mode = filemode(mode)
 
+    # one stat per path instead of an access() call per mode
+    euid = os.geteuid()
+    gids = set(os.getgroups())
+    gids.add(os.getegid())
+
     reason = None
     while pathname and reason is None:
 
+        try:
+            allowed = _allowed_access(os.stat(pathname), euid, gids)
+        except OSError:
+            allowed = ''
+
         for perm in mode:
 
-            if (('r' in perm and not is_readable(pathname)) or
-                (('w' in perm or 'a' in perm or '+' in perm) and not is_writeable(pathname)) or
-                (('x' in perm or 's' in perm) and not is_executable(pathname))):
+            if (('r' in perm and 'r' not in allowed) or
+                (('w' in perm or 'a' in perm or '+' in perm) and 'w' not in allowed) or
+                (('x' in perm or 's' in perm) and 'x' not in allowed)):
 
                 reason = f'no "{perm}" access for {pathname}'
 
-        if pathname:
-            # remove last component of pathname
-            parts = pathname.split('/')
-            pathname = '/'.join(parts[:-1])
+        # remove last component of pathname
+        # stop before the root dir
+        parent = os.path.dirname(pathname)
+        pathname = '' if parent in (pathname, '/') else parent
 
     if reason:
         reason += f' as user {whoami()}'
 
     return reason
 
+def _allowed_access(statinfo, euid, gids):
+    ''' Return the access, as a string of 'r', 'w', and 'x', that the
+        permission bits in statinfo allow for euid and gids.
+
+        Like access(), root can read and write anything, and execute
+        anything that is a dir or that anyone can execute.
+        ACLs are not checked.
+
+        >>> statinfo = os.stat_result((stat.S_IFREG | 0o640, 0, 0, 0, 1000, 100, 0, 0, 0, 0))
+        >>> _allowed_access(statinfo, 1000, {1000})
+        'rw'
+        >>> _allowed_access(statinfo, 1001, {100})
+        'r'
+        >>> _allowed_access(statinfo, 1001, {1001})
+        ''
+        >>> _allowed_access(statinfo, 0, {0})
+        'rw'
+    '''
+
+    st_mode = statinfo.st_mode
+
+    if euid == 0:
+        allowed = 'rw'
+        if stat.S_ISDIR(st_mode) or st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
+            allowed += 'x'
+
+    else:
+        if statinfo.st_uid == euid:
+            bits = (st_mode & stat.S_IRWXU) >> 6
+        elif statinfo.st_gid in gids:
+            bits = (st_mode & stat.S_IRWXG) >> 3
+        else:
+            bits = st_mode & stat.S_IRWXO
+
+        allowed = ''
+        if bits & 4:
+            allowed += 'r'
+        if bits & 2:
+            allowed += 'w'
+        if bits & 1:
+            allowed += 'x'
+
+    return allowed
+
 def replace_file(filename, content):
     ''' Replace or create file content.
 
         Perserves permissions.
+
+        An existing file is replaced atomically if we can create a temp
+        file in its dir. Readers see the old content or the new, never
+        a partly written file.
+
+        >>> f = tempfile.NamedTemporaryFile(mode='w', delete=False)
+        >>> f.close()
+        >>> os.chmod(f.name, 0o604)
+        >>> replace_file(f.name, 'new content')
+        >>> with open(f.name) as textfile:
+        ...     textfile.read()
+        'new content'
+        >>> oct(getmode(f.name))
+        '0o604'
+
+        A file with hard links is written in place, so every link
+        sees the new content.
+
+        >>> link = f.name + '.link'
+        >>> os.link(f.name, link)
+        >>> replace_file(f.name, 'linked content')
+        >>> with open(link) as textfile:
+        ...     textfile.read()
+        'linked content'
+        >>> os.remove(link)
+        >>> os.remove(f.name)
     '''
 
-    if os.path.exists(filename):
-        mode = os.stat(filename).st_mode
+    # replace the real file, not a link to it
+    path = os.path.realpath(filename)
+    try:
+        statinfo = os.stat(path)
+    except FileNotFoundError:
+        newfile = None
     else:
-        mode = None
-    with open(filename, 'w') as f:
-        f.write(content)
-    if mode is not None:
-        os.chmod(filename, mode)
-        assert mode == os.stat(filename).st_mode
+        newfile = _sibling_temp_file(path)
+
+    if newfile is None:
+        # a new file, or we can write the file but not its dir
+        _write_in_place(path, content)
+
+    else:
+        try:
+            with newfile:
+                newfile.write(content)
+            if not _replace_with_temp(newfile.name, path, statinfo):
+                _write_in_place(path, content)
+        finally:
+            if os.path.exists(newfile.name):
+                os.remove(newfile.name)
 
 def is_readable(path, effective_ids=True):
     ''' Return whether the path is readable by the current user '''
@@ -1195,18 +2004,42 @@ def flush(f):
     os.fsync(f.fileno())
 
 def get_dir_size(start_path = '.'):
-    ''' Return size of dir including subdirs. '''
+    ''' Return size of dir including subdirs.
 
-    # from Calculating a directory's size using Python? - Stack Overflow
-    #      https://stackoverflow.com/questions/1392413/calculating-a-directorys-size-using-python
+        Symbolic links are not counted or followed.
+
+        >>> testdir = tempfile.mkdtemp()
+        >>> makedir(os.path.join(testdir, 'subdir'))
+        >>> with open(os.path.join(testdir, 'subdir', 'file'), 'w') as testfile:
+        ...     testfile.write('data')
+        4
+        >>> os.symlink('subdir', os.path.join(testdir, 'link'))
+        >>> get_dir_size(testdir)
+        4
+        >>> remove(testdir)
+    '''
+
+    # scandir() entries know whether they are links or dirs without
+    # another stat, so each file costs one lstat for its size
 
     total_size = 0
-    for dirpath, __, filenames in os.walk(start_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            # skip if it is symbolic link
-            if not os.path.islink(fp):
-                total_size += os.path.getsize(fp)
+    dirs = [start_path]
+    while dirs:
+        try:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    # symbolic links are neither dirs nor files here
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        try:
+                            total_size += entry.stat(follow_symlinks=False).st_size
+                        except FileNotFoundError:
+                            # removed since we listed the dir
+                            pass
+        except OSError:
+            # like os.walk(), skip dirs we can't read
+            pass
 
     return total_size
 
@@ -12,9 +12,12 @@
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 
+import json
 import os
 import socket
+import sys
 import threading
+from ast import literal_eval
 from contextlib import contextmanager
 from datetime import timedelta
 from functools import wraps
@@ -34,6 +37,8 @@ DEBUGGING = False
 SAFELOCK_HOST = 'localhost'
 SAFELOCK_PORT = 8674
 BIND_ADDR = (SAFELOCK_HOST, SAFELOCK_PORT)
+# used instead of BIND_ADDR when a local safelock listens on a unix socket
+SAFELOCK_SOCKET_PATH = '/run/safelock.sock'
 MAX_PACKET_SIZE = 1024
 
 ACTION_KEY = 'action'
@@ -51,10 +56,21 @@ WHY_UNKNOWN = 'safelock did not say why'
 
 DEFAULT_TIMEOUT = timedelta.max
 
+# seconds between retries when safelock says no. A lock that was just
+# released is usually available again within a few milliseconds, so
+# start short and back off exponentially for contended locks.
+MIN_RETRY_DELAY = 0.001
+MAX_RETRY_DELAY = 0.1
+
 # global variables
 log = Log()
 # WARNING: BUG. python globals are not multiprocess-safe.
 synchronized_locks = {}
+synchronized_registry_lock = threading.Lock()
+# locknames held through locked(), per thread
+held_locks = threading.local()
+# default locknames by (filename, line number) of the call to locked()
+default_locknames = {}
 
 class LockTimeout(Exception):
     pass
@@ -81,6 +97,10 @@ def locked(lockname=None, timeout=None, server_required=True):
         is down, set server_required=False. This should only be
         used for critical code.
 
+        locked() is reentrant within a thread. If this thread is already
+        inside locked() with the same lockname, the inner locked() doesn't
+        ask safelock again, and doesn't unlock when it exits.
+
         With locked() you don't have to initialize each lock in an
         an outer scope, as you do with raw multiprocessing.Lock().
 
@@ -109,15 +129,26 @@ def locked(lockname=None, timeout=None, server_required=True):
     '''
 
     is_locked = False
+    is_reentry = False
 
     try:
 
         if not lockname:
-            lockname = caller_id(ignore=[__file__, r'.*/contextlib.py'])
+            lockname = default_lockname()
 
-        is_locked, nonce, pid = lock(lockname, timeout, server_required=server_required)
-        if DEBUGGING:
+        held_locknames = thread_held_locknames()
+        if lockname in held_locknames:
+            # this thread already holds the lock
+            is_reentry = True
+        else:
+            is_locked, nonce, pid = lock(lockname, timeout, server_required=server_required)
             if is_locked:
+                held_locknames.add(lockname)
+
+        if DEBUGGING:
+            if is_reentry:
+                log(f'{lockname} already locked by this thread')
+            elif is_locked:
                 if timeout is None:
                     log(f'{lockname} locked with no timeout')
                 else:
@@ -139,10 +170,52 @@ def locked(lockname=None, timeout=None, server_required=True):
             yield
         finally:
             if is_locked:
+                held_locknames.discard(lockname)
                 unlock(lockname, nonce, pid, timeout, server_required=server_required)
                 if DEBUGGING:
                     log(f'{lockname} unlocked')
 
+def thread_held_locknames():
+    ''' Return the set of locknames this thread holds through locked(). '''
+
+    try:
+        locknames = held_locks.locknames
+    except AttributeError:
+        locknames = set()
+        held_locks.locknames = locknames
+
+    return locknames
+
+def default_lockname():
+    ''' Return the default lockname for the code that called locked().
+
+        The default lockname is the same every time for a given source
+        line. Finding the caller's frame is cheap, but caller_id()
+        extracts the whole stack. So caller_id() is only called once
+        per source line.
+
+        >>> default_lockname() == default_lockname()
+        True
+    '''
+
+    ignored_filenames = (__file__, contextmanager.__code__.co_filename)
+
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename in ignored_filenames:
+        frame = frame.f_back
+
+    if frame is None:
+        lockname = caller_id(ignore=[__file__, r'.*/contextlib.py'])
+
+    else:
+        key = (frame.f_code.co_filename, frame.f_lineno)
+        lockname = default_locknames.get(key)
+        if lockname is None:
+            lockname = caller_id(ignore=[__file__, r'.*/contextlib.py'])
+            default_locknames[key] = lockname
+
+    return lockname
+
 def lock(lockname, timeout=None, server_required=True):
     '''
         Lock a process or thread to prevent concurrency issues.
@@ -230,6 +303,7 @@ def lock(lockname, timeout=None, server_required=True):
     loop_count = 0
     is_locked = False
     last_warning = None
+    retry_delay = MIN_RETRY_DELAY
     while not is_locked:
         try:
             is_locked, nonce = try_to_lock(lockname, pid, server_required=server_required)
@@ -256,7 +330,8 @@ def lock(lockname, timeout=None, server_required=True):
                 log.warning(warning_msg)
                 raise LockTimeout(warning_msg)
 
-            sleep(0.1)
+            sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
 
         loop_count = loop_count + 1
 
@@ -268,8 +343,7 @@ def try_to_lock(lockname, pid, server_required=True):
     is_locked = False
     nonce = None
 
-    # Create a socket (SOCK_STREAM means a TCP socket)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    with new_socket() as sock:
 
         connected = connect_to_server(sock, server_required=server_required)
 
@@ -280,7 +354,7 @@ def try_to_lock(lockname, pid, server_required=True):
                     PID_KEY: pid}
             # log(f'about to send lock request: {data}')
             try:
-                sock.sendall(repr(data).encode())
+                sock.sendall(json.dumps(data).encode())
                 # log('finished sending lock request')
 
             except BrokenPipeError as bpe:
@@ -292,7 +366,7 @@ def try_to_lock(lockname, pid, server_required=True):
                 data = sock.recv(MAX_PACKET_SIZE)
                 # log(f'finished receiving lock data: {data}')
                 try:
-                    response = eval(data.decode())
+                    response = parse_response(data)
                 except:             # pylint:bare-except -- catches more than "except Exception"
                     log(format_exc())
                     is_locked = False
@@ -342,6 +416,7 @@ def unlock(lockname, nonce, pid, timeout=None, server_required=True):
     # we must be persistent in case the Safelock is busy
     is_locked = True
     last_warning = None
+    retry_delay = MIN_RETRY_DELAY
     while is_locked:
         try:
             is_locked = try_to_unlock(lockname,
@@ -370,7 +445,8 @@ def unlock(lockname, nonce, pid, timeout=None, server_required=True):
                 log.warning(f'unlock timed out: {lockname}')
                 raise LockTimeout(warning_msg)
 
-            sleep(0.1)
+            sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
 
     # log(f'unlocked: {lockname}') # DEBUG
 
@@ -382,8 +458,7 @@ def try_to_unlock(lockname, nonce, pid, server_required=True):
 
     is_locked = True
 
-    # Create a socket (SOCK_STREAM means a TCP socket)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+    with new_socket() as sock:
 
         connected = connect_to_server(sock, server_required=server_required)
 
@@ -396,7 +471,7 @@ def try_to_unlock(lockname, nonce, pid, server_required=True):
             # log(f'about to send unlock request: {data}')
 
             try:
-                sock.sendall(repr(data).encode())
+                sock.sendall(json.dumps(data).encode())
                 # log('finished sending unlock request')
 
             except BrokenPipeError as bpe:
@@ -410,7 +485,7 @@ def try_to_unlock(lockname, nonce, pid, server_required=True):
                 #log(f'finished receiving unlock data: {data}')
 
                 try:
-                    response = eval(data.decode())
+                    response = parse_response(data)
                 except:             # pylint:bare-except -- catches more than "except Exception"
                     log(format_exc())
                     is_locked = False
@@ -430,12 +505,46 @@ def try_to_unlock(lockname, nonce, pid, server_required=True):
 
     return is_locked
 
+def parse_response(data):
+    ''' Parse a response from safelock.
+
+        Safelock responses are JSON. Never eval() socket data. Older
+        servers reply with a python dict literal, which we parse with
+        ast.literal_eval().
+
+        >>> parse_response(b'{"ok": true, "action": "lock", "lockname": "lock1"}')
+        {'ok': True, 'action': 'lock', 'lockname': 'lock1'}
+        >>> parse_response(b"{'ok': True, 'action': 'lock', 'lockname': 'lock1'}")
+        {'ok': True, 'action': 'lock', 'lockname': 'lock1'}
+        >>> parse_response(b'__import__("os")') # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        ValueError: malformed node or string on line 1: <ast.Call object at ...>
+    '''
+
+    text = data.decode()
+    try:
+        response = json.loads(text)
+    except json.JSONDecodeError:
+        response = literal_eval(text)
+
+    return response
+
 def synchronized(function):
     ''' Decorator to lock a function so each call completes before
         another call starts.
 
         If you use both the staticmethod and synchronized decorators,
         @staticmethod must come before @synchronized.
+
+        Each decorated function has its own lock, so calls to different
+        synchronized functions don't wait for each other.
+
+        >>> @synchronized
+        ... def add(a, b):
+        ...     return a + b
+        >>> add(1, 2)
+        3
     '''
 
     @wraps(function)
@@ -443,15 +552,11 @@ def synchronized(function):
         ''' Lock function access so only one call at a time is active.'''
 
         # get a shared lock for the function
-        with locked():
-            lock_name = object_name(function)
-            if lock_name in synchronized_locks:
-                synch_lock = synchronized_locks[lock_name]
-            else:
-                synch_lock = threading.Lock()
-                synchronized_locks[lock_name] = synch_lock
+        lock_name = object_name(function)
+        with synchronized_registry_lock:
+            synch_lock = synchronized_locks.setdefault(lock_name, threading.Lock())
 
-        with locked():
+        with synch_lock:
             result = function(*args, **kwargs)
 
         return result
@@ -499,22 +604,66 @@ def get_deadline(timeout=None):
     # log(f'deadline: {deadline}')
     return deadline
 
+def new_socket():
+    ''' Return a new socket for a safelock request.
+
+        Safelock reads one unframed request per connection and closes
+        the connection after it replies, so we can't keep connections
+        open between requests.
+
+        If safelock is local and listens on SAFELOCK_SOCKET_PATH, use a
+        unix socket. That skips the TCP/IP stack. The unix socket is
+        returned already connected. If the socket path is stale, e.g.
+        left behind by a safelock that died, use TCP instead.
+        Requests and responses are small, so for TCP turn off Nagle's
+        algorithm. Otherwise a request can wait for the delayed ACK of
+        a previous packet.
+
+        >>> with new_socket() as sock:
+        ...     if sock.family == socket.AF_INET:
+        ...         sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY) != 0
+        ...     else:
+        ...         True
+        True
+    '''
+
+    sock = None
+    if SAFELOCK_HOST == 'localhost' and os.path.exists(SAFELOCK_SOCKET_PATH):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(SAFELOCK_SOCKET_PATH)
+        except (ConnectionRefusedError, FileNotFoundError):
+            sock.close()
+            sock = None
+
+    if sock is None:
+        # SOCK_STREAM means a TCP socket
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return sock
+
 def connect_to_server(sock, server_required=True):
     ''' Connect to Safelock. '''
 
+    # new_socket() returns unix sockets already connected
+    if sock.family == socket.AF_UNIX:
+        return True
+
     connected = False
+    address = f'{SAFELOCK_HOST}:{SAFELOCK_PORT}'
 
     try:
         sock.connect(BIND_ADDR)
 
-    except ConnectionRefusedError:
+    except (ConnectionRefusedError, FileNotFoundError):
         if server_required:
-            msg = f'Requires safelock package available on PyPI. No lock server at {SAFELOCK_HOST}:{SAFELOCK_PORT}'
+            msg = f'Requires safelock package available on PyPI. No lock server at {address}'
             log.error(msg)
             raise LockFailed(msg)
 
         else:
-            log.warning(f'No lock server at {SAFELOCK_HOST}:{SAFELOCK_PORT}, but server_required={server_required}')
+            log.warning(f'No lock server at {address}, but server_required={server_required}')
 
     else:
         connected = True
@@ -7,18 +7,51 @@
     This file is open source, licensed under GPLv3 <http://www.gnu.org/licenses/>.
 '''
 
+import sys
+from functools import lru_cache
 from platform import system
 
+# (sys.platform prefix, os name) for common platforms, so we don't
+# need platform.system(). On Windows it can start a subprocess.
+# Each os name is what platform.system().lower() returns.
+OS_NAMES = (
+    ('linux', 'linux'),
+    ('win32', 'windows'),
+    ('darwin', 'darwin'),
+    ('aix', 'aix'),
+    ('sunos', 'sunos'),
+    )
+
+@lru_cache(maxsize=None)
 def get_os_name():
     '''
         Return the name of the OS in lower case.
 
+        The OS doesn't change while we run, so this and the is_*()
+        functions are cached.
+
         >>> get_os_name()
         'linux'
+
+        >>> platform = sys.platform
+        >>> sys.platform = 'darwin'
+        >>> refresh()
+        >>> get_os_name()
+        'darwin'
+        >>> sys.platform = platform
+        >>> refresh()
     '''
 
-    return system().lower()
+    for prefix, name in OS_NAMES:
+        if sys.platform.startswith(prefix):
+            os_name = name
+            break
+    else:
+        os_name = system().lower()
+
+    return os_name
 
+@lru_cache(maxsize=None)
 def is_windows():
     '''
         Return True if the underlying OS is any variant of Windows.
@@ -30,77 +63,85 @@ def is_windows():
     osname = get_os_name()
     return osname.startswith("win") or osname.startswith("microsoft windows")
 
+@lru_cache(maxsize=None)
+def _windows_version_tokens():
+    ''' Return the set of Windows version tokens in the OS name.
+
+        The OS name is scanned once for all of the is_windows*()
+        version checks.
+
+        >>> _windows_version_tokens()
+        frozenset()
+    '''
+
+    tokens = set()
+    if is_windows():
+        osname = get_os_name()
+        for token in ("xp", "2000", "vista", "7", "8", "10"):
+            # the OS name starts with "win", so a token is never at 0
+            if osname.find(token) > 0:
+                tokens.add(token)
+
+    return frozenset(tokens)
+
+@lru_cache(maxsize=None)
 def is_windows_vista():
     ''' Return True if the underlying OS is Windows Vista.
 
         >>> is_windows_vista()
         False
     '''
-    winVista = False
-    osname = get_os_name()
-    if is_windows():
-        winVista = osname.find("vista") > 0
-    return winVista
+    return "vista" in _windows_version_tokens()
 
+@lru_cache(maxsize=None)
 def is_windows7():
     ''' Return True if the underlying OS is Windows 7.
 
         >>> is_windows7()
         False
     '''
-    win7 = False
-    osname = get_os_name()
-    if is_windows():
-        win7 = osname.find("7") > 0
-    return win7
+    return "7" in _windows_version_tokens()
 
+@lru_cache(maxsize=None)
 def is_windows8():
     ''' Return True if the underlying OS is Windows 8.
 
         >>> is_windows8()
         False
     '''
-    win8 = False
-    osname = get_os_name()
-    if is_windows():
-        win8 = osname.find("8") > 0
-    return win8
+    return "8" in _windows_version_tokens()
 
+@lru_cache(maxsize=None)
 def is_windows10():
     ''' Return True if the underlying OS is Windows 10.
 
         >>> is_windows10()
         False
     '''
-    win10 = False
-    osname = get_os_name()
-    if is_windows():
-        win10 = osname.find("10") > 0
-    return win10
+    return "10" in _windows_version_tokens()
 
+@lru_cache(maxsize=None)
 def is_windows_xp():
     ''' Return True if the underlying OS is Windows XP.
 
         >>> is_windows_xp()
         False
     '''
-    winXP = False
-    osname = get_os_name()
-    if is_windows():
-        #  sometimes XP falsely reports that its W2K
-        if osname.find("xp") > 0 or osname.find("2000") > 0:
-            winXP = True
-    return winXP
+    #  sometimes XP falsely reports that its W2K
+    return bool({"xp", "2000"} & _windows_version_tokens())
 
+@lru_cache(maxsize=None)
 def is_unix():
     ''' Return True if the underlying OS is any variant of unix.
 
         >>> is_unix()
         True
     '''
-    osname = get_os_name()
-    return osname.find("unix") >= 0 or is_linux() or is_aix() or is_hp_unix() or is_solaris() or is_mac_os_x()
+    # the most likely answers first, so "or" stops early
+    return (is_linux() or is_mac_os_x() or "unix" in get_os_name() or
+            is_aix() or is_hp_unix() or is_solaris())
 
+@lru_cache(maxsize=None)
 def is_linux():
     ''' Return True if the underlying OS is Linux.
 
@@ -110,6 +151,7 @@ def is_linux():
     osname = get_os_name()
     return osname.find("linux") >= 0
 
+@lru_cache(maxsize=None)
 def is_aix():
     ''' Return True if the underlying OS is IBM's AIX.
 
@@ -119,6 +161,7 @@ def is_aix():
     osname = get_os_name()
     return osname.find("aix") >= 0
 
+@lru_cache(maxsize=None)
 def is_hp_unix():
     ''' Return True if the underlying OS is HP's unix.
 
@@ -128,6 +171,7 @@ def is_hp_unix():
     osname = get_os_name()
     return osname.find("hp-ux") >= 0 or osname.find("hpux") >= 0 or osname.find("irix") >= 0
 
+@lru_cache(maxsize=None)
 def is_solaris():
     ''' Return True if the underlying OS is Solaris.
 
@@ -137,6 +181,7 @@ def is_solaris():
     osname = get_os_name()
     return osname.find("solaris") >= 0 or osname.find("sunos") >= 0
 
+@lru_cache(maxsize=None)
 def is_mac_os_x():
     ''' Return True if the underlying OS is Mac OS X.
 
@@ -146,6 +191,7 @@ def is_mac_os_x():
     osname = get_os_name()
     return osname.find("mac os x") >= 0
 
+@lru_cache(maxsize=None)
 def is_mac():
     ''' Return True if the underlying OS is any variant of Mac.
 
@@ -154,3 +200,18 @@ def is_mac():
     '''
     osname = get_os_name()
     return osname.find("mac os") >= 0 or osname.find("macos") >= 0
+
+def refresh():
+    ''' Forget the cached OS identification.
+
+        The next get_os_name() or is_*() call detects the OS again,
+        e.g. after a test changes sys.platform.
+
+        >>> refresh()
+        >>> get_os_name()
+        'linux'
+    '''
+
+    for function in list(globals().values()):
+        if callable(function) and hasattr(function, 'cache_clear'):
+            function.cache_clear()
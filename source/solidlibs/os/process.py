@@ -14,7 +14,6 @@
 import datetime
 import os
 import signal
-import subprocess
 import sys
 import time
 from contextlib import contextmanager
@@ -32,6 +31,13 @@ if version < 3:
 log = Log()
 DEBUGGING = False
 
+# how long kill() waits for a process to exit after each signal
+KILL_WAIT_SECONDS = 0.05
+
+# set by process_snapshot()
+pinned_snapshot = None
+pinned_socket_pids = None
+
 
 class TimedOutException(Exception):
     ''' Operation timed out exception. '''
@@ -49,16 +55,32 @@ def pid_from_port(port):
 
         Returns None if none.
 
+        Without root, only finds this user's processes. Inside
+        process_snapshot(), open sockets are only listed once, however
+        many ports you check.
+
         >>> from solidlibs.os.user import whoami
         >>> if whoami == 'root':
         ...     pids = pid_from_port(9988)
         ...     pids is None
         ... else: print(True)
         True
+
+        >>> import socket
+        >>> with socket.socket() as sock:
+        ...     sock.bind(('127.0.0.1', 0))
+        ...     sock.listen()
+        ...     pid_from_port(sock.getsockname()[1]) == os.getpid()
+        True
     '''
 
-    # fuser requires --namespace before port, so can't use namespace='tcp'
-    pids = pids_from_fuser('--namespace', 'tcp', port)
+    # like "fuser --namespace tcp PORT", but without starting fuser
+    socket_pids = _socket_pids()
+    pids = set()
+    for inode in _tcp_socket_inodes(int(port)):
+        pids.update(socket_pids.get(inode, ()))
+    pids = sorted(pids)
+
     if pids:
         assert len(pids) == 1, f'pids: {pids}'
         pid = pids[0]
@@ -67,6 +89,64 @@ def pid_from_port(port):
         result = None
     return result
 
+def _tcp_socket_inodes(port):
+    ''' Return the set of inodes of TCP sockets on local port. '''
+
+    inodes = set()
+    for path in ['/proc/net/tcp', '/proc/net/tcp6']:
+        try:
+            with open(path) as tcp_file:
+                # skip the header
+                next(tcp_file)
+                for line in tcp_file:
+                    fields = line.split()
+                    __, __, local_port = fields[1].rpartition(':')
+                    inode = int(fields[9])
+                    if int(local_port, 16) == port and inode:
+                        inodes.add(inode)
+        except FileNotFoundError:
+            # no IPv6
+            pass
+
+    return inodes
+
+def _socket_pids():
+    ''' Return {socket inode: set of pids} for open sockets.
+
+        Inside process_snapshot(), the sockets are only listed once.
+    '''
+
+    global pinned_socket_pids
+
+    if pinned_socket_pids is None:
+        socket_pids = {}
+        with os.scandir('/proc') as entries:
+            for entry in entries:
+                if entry.name.isdigit():
+                    try:
+                        with os.scandir(f'/proc/{entry.name}/fd') as fds:
+                            for fd in fds:
+                                try:
+                                    target = os.readlink(fd.path)
+                                except OSError:
+                                    # the file was closed
+                                    continue
+                                # e.g. "socket:[12345]"
+                                if target.startswith('socket:['):
+                                    inode = int(target[8:-1])
+                                    socket_pids.setdefault(inode, set()).add(int(entry.name))
+                    except OSError:
+                        # the process ended, or we can't see its files
+                        pass
+
+        if pinned_snapshot is not None:
+            pinned_socket_pids = socket_pids
+
+    else:
+        socket_pids = pinned_socket_pids
+
+    return socket_pids
+
 def pids_from_file(path):
     ''' Get list of pids that have the file or dir open.
 
@@ -95,14 +175,72 @@ def pids_from_program(program):
         True
     '''
 
+    # like pidof, but without starting pidof
+    # a path can be through a link to the program, e.g. /bin is a link to /usr/bin
+    program_path = os.path.realpath(program) if '/' in program else None
+
+    pids = []
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if entry.name.isdigit() and _is_program(entry.name, program, program_path):
+                pids.append(int(entry.name))
+
+    return pids
+
+def _is_program(pid, program, program_path=None):
+    ''' Return True if the process is running program.
+
+        Like pidof, program can be the path or the basename of the
+        program file, or of the command that started it.
+        'program_path' is the real path of program, if program is a path.
+
+        >>> _is_program(str(os.getpid()), sys.executable)
+        True
+        >>> _is_program(str(os.getpid()), 'not.running')
+        False
+    '''
+
+    names = []
+
     try:
-        pid_strings = run('pidof', program).stdout.strip().split()
-    except subprocess.CalledProcessError:
-        pids = []
+        exe = os.readlink(f'/proc/{pid}/exe')
+    except PermissionError:
+        # we can't see other users' programs, but can see their names
+        exe = None
+        try:
+            with open(f'/proc/{pid}/comm') as comm_file:
+                names.append(comm_file.read().rstrip('\n'))
+        except OSError:
+            pass
+    except OSError:
+        # the process ended, or is a kernel thread or zombie
+        exe = None
     else:
-        pids = [int(pid) for pid in pid_strings]
+        names.append(exe)
 
-    return pids
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as cmdline_file:
+            argv0 = cmdline_file.read().split(b'\0', 1)[0]
+    except OSError:
+        pass
+    else:
+        if argv0:
+            names.append(argv0.decode(errors='replace'))
+
+    if not names:
+        # kernel threads only have a name
+        try:
+            name, state, __ = _proc_stat(pid)
+        except OSError:
+            pass
+        else:
+            if state != 'Z':
+                names.append(name)
+
+    is_program = (any(program in (name, os.path.basename(name)) for name in names) or
+                  (program_path is not None and program_path == exe))
+
+    return is_program
 
 def program_from_pid(pid):
     ''' Find which program has the pid.
@@ -155,6 +293,9 @@ def program_from_port(port):
 def programs_using_file(path):
     ''' Find which programs have the file or dir open.
 
+        Each program is listed by its full path, as from
+        program_from_pid(), and by its command name, as lsof shows it.
+
         Returns None if none.
 
         >>> from solidlibs.os.user import whoami
@@ -163,30 +304,26 @@ def programs_using_file(path):
         ...     programs is None
         ... else: print(False)
         False
+        >>> os.path.realpath(sys.executable) in programs_using_file(os.path.realpath(sys.executable))
+        True
     '''
 
     programs = set()
 
-    # fuser
-    pids = pids_from_file(path)
-    if pids:
-        log.debug(f'pids using {path}: {pids}')
-
-        for pid in pids:
-            program = program_from_pid(pid)
-            if program:
-                programs.add(program)
-            else:
-                log.debug(f'no program from pid  {pid}')
-
-    # lsof
-    lines = run('lsof').stdout.strip().split('\n')
-    for line in lines:
-        fields = line.split()
-        command = fields[0]
-        command_path = fields[-1]
-        if command_path == path or command_path.startswith(path + '/'):
-            programs.add(command)
+    # like fuser and lsof, but without starting either one
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                try:
+                    if _uses_path(entry.name, path):
+                        program = program_from_pid(entry.name)
+                        if program:
+                            programs.add(program)
+                        with open(f'/proc/{entry.name}/comm') as comm_file:
+                            programs.add(comm_file.read().strip())
+                except OSError:
+                    # the process ended, or we can't see its files
+                    pass
 
     if programs:
         programs = sorted(programs)
@@ -195,6 +332,50 @@ def programs_using_file(path):
 
     return programs
 
+def _uses_path(pid, path):
+    ''' Return True if the process has path, or anything in the path
+        dir, open. This includes its current dir, root dir, program,
+        and memory mapped files, as lsof reports them.
+
+        >>> _uses_path(str(os.getpid()), os.path.realpath(sys.executable))
+        True
+        >>> _uses_path(str(os.getpid()), '/not/a/path')
+        False
+    '''
+
+    def is_in_path(target):
+        return target == path or target.startswith(path_prefix)
+
+    path_prefix = os.path.join(path, '')
+
+    targets = []
+    for name in ['cwd', 'root', 'exe']:
+        try:
+            targets.append(os.readlink(f'/proc/{pid}/{name}'))
+        except OSError:
+            pass
+
+    with os.scandir(f'/proc/{pid}/fd') as entries:
+        for entry in entries:
+            try:
+                targets.append(os.readlink(entry.path))
+            except OSError:
+                # the file was closed
+                pass
+
+    uses_path = any(is_in_path(target) for target in targets)
+
+    if not uses_path:
+        with open(f'/proc/{pid}/maps') as maps_file:
+            for line in maps_file:
+                # the mapped path, if any, is the last field
+                fields = line.split(maxsplit=5)
+                if len(fields) > 5 and is_in_path(fields[5].rstrip('\n')):
+                    uses_path = True
+                    break
+
+    return uses_path
+
 def pids_from_fuser(*args):
     ''' Get list of pids using fuser.
 
@@ -263,13 +444,11 @@ def get_pid(program_name):
         <class 'int'>
     '''
 
-    pid = None
-
-    line = find_active_program(program_name)
-    if line is not None:
-        index = line.find(' ')
-        if index > 0:
-            pid = int(line[:index])
+    info = program_info(program_name)
+    if info is None:
+        pid = None
+    else:
+        pid, __, __ = info
 
     return pid
 
@@ -282,12 +461,15 @@ def wait_for_children():
         >>> wait_for_children()
     '''
 
+    # wait_any_child() blocks until a child finishes, so no need to sleep
     while wait_any_child():
-        time.sleep(0.1)
+        pass
 
-def wait_any_child():
+def wait_any_child(block=True):
     ''' Wait for any child process to finish.
 
+        If block=False, don't wait. Just check for a finished child.
+
         Returns:
             (pid, signal, exit_code)
 
@@ -295,6 +477,9 @@ def wait_any_child():
             signal: the signal number that killed the process, or zero
             exit_code: the process exit code
 
+        Returns None if there are no children, or if block=False and no
+        child has finished.
+
         >>> from solidlibs.os.command import background
         >>> pids = []
         >>> for secs in range(3):
@@ -311,17 +496,30 @@ def wait_any_child():
         ...         assert exit_code == 0
         ...     else:
         ...         done = True
+
+        >>> process = background('sleep', 1)
+        >>> wait_any_child(block=False) is None
+        True
+        >>> wait_any_child()[0] == process.pid
+        True
     '''
 
     ANY_CHILD_PID = -1 # any child of this process
-    OPTIONS = 0 # os.WEXITED | os.WSTOPPED
+    OPTIONS = 0 if block else os.WNOHANG # os.WEXITED | os.WSTOPPED
 
     try:
-        result = decode_wait_result(os.waitpid(ANY_CHILD_PID, OPTIONS))
+        pid, exit_status = os.waitpid(ANY_CHILD_PID, OPTIONS)
 
     except ChildProcessError:
         result = None
 
+    else:
+        # with WNOHANG, pid 0 means no child has finished yet
+        if pid == 0:
+            result = None
+        else:
+            result = decode_wait_result((pid, exit_status))
+
     return result
 
 def decode_wait_result(result):
@@ -335,18 +533,21 @@ def decode_wait_result(result):
 
 
 def child_pids():
-    ''' Return all child pids. '''
+    ''' Return all child pids.
 
-    # verbose(f'in child_pids() os.getpid(): {os.getpid()}') # DEBUG
-    result = run('pgrep', '--parent', os.getpid())
-    candidate_pids = list(map(int, result.stdout.split()))
-    # verbose(f'in child_pids() candidate_pids: {candidate_pids}') # DEBUG
-    # remove zombies
-    pids = []
-    for pid in candidate_pids:
-        if is_pid_active(pid):
-            pids.append(pid)
-    # verbose(f'in child_pids() pids: {pids}') # DEBUG
+        >>> from solidlibs.os.command import background
+        >>> process = background('sleep', 1)
+        >>> process.pid in child_pids()
+        True
+        >>> process.wait()
+        0
+    '''
+
+    parent_pid = os.getpid()
+
+    # skip zombies
+    pids = [pid for pid, (state, ppid) in _proc_snapshot().items()
+            if ppid == parent_pid and state != 'Z']
 
     return pids
 
@@ -364,15 +565,44 @@ def get_path(program_name):
         <class 'str'>
     '''
 
-    path = None
+    info = program_info(program_name)
+    if info is None:
+        path = None
+    else:
+        __, path, __ = info
+
+    return path
+
+def program_info(program_name):
+    '''
+        Return (pid, path, raw_line) for the first matching program if
+        it is running and not defunct. Else return None.
+
+        Use this instead of separate get_pid(), get_path(), and
+        find_active_program() calls, so the processes are only
+        searched once.
+
+        See find_active_program() for details on program_name.
+
+        >>> pid, path, raw_line = program_info(sys.executable)
+        >>> raw_line.startswith(f'{pid} {path}')
+        True
+        >>> program_info('not.running') is None
+        True
+    '''
+
+    info = None
 
     line = find_active_program(program_name)
     if line is not None:
         parts = line.split()
         if len(parts) > 1:
-            path = parts[1]
+            pid, path = int(parts[0]), parts[1]
+        else:
+            pid, path = int(parts[0]), None
+        info = (pid, path, line)
 
-    return path
+    return info
 
 def find_active_program(program_name):
     '''
@@ -392,9 +622,8 @@ def find_active_program(program_name):
     raw_line = None
 
     try:
-        raw_lines = program_status(program_name)
-        if raw_lines:
-            raw_line = raw_lines[0]
+        # stop at the first match
+        raw_line = next(_matching_lines(program_name), None)
     except:   # noqa
         log(format_exc())
         raw_line = None
@@ -408,27 +637,149 @@ def program_status(program_name):
         If no lines match, returns an empty list.
         Ignores any program_name that is defunct.
 
+        The lines are in the format of "ps -eo pid,args", but are read
+        from /proc without starting ps.
+
         >>> lines = program_status('python3')
         >>> lines == []
         False
     '''
-    PS_ARGS = ['-eo', 'pid,args']
 
     lines = []
     try:
-        raw = run('ps', *PS_ARGS)
-        raw_lines = raw.stdout.strip().split('\n')
-
-        for line in raw_lines:
-            line = str(line).strip()
-            # apparent the leading space matters
-            if program_name in line and ' <defunct>' not in line:
-                lines.append(line)
+        lines = list(_matching_lines(program_name))
     except:   # noqa
         log(format_exc())
 
     return lines
 
+def _matching_lines(program_name):
+    '''
+        Generate the program_status() lines that match program_name.
+    '''
+
+    # search the raw bytes, and only decode matching lines
+    program_name_bytes = program_name.encode()
+
+    with os.scandir('/proc') as entries:
+        for entry in entries:
+            if entry.name.isdigit():
+                line = _process_line(entry.name)
+                if line is not None and program_name_bytes in line:
+                    yield line.decode(errors='replace')
+
+def _process_line(pid):
+    '''
+        Return the "ps -eo pid,args" line for pid, as bytes.
+
+        Returns None if the process is defunct or gone.
+
+        >>> pid = os.getpid()
+        >>> _process_line(str(pid)).startswith(f'{pid} {sys.executable}'.encode())
+        True
+        >>> _process_line('999999999') is None
+        True
+    '''
+
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as cmdline_file:
+            cmdline = cmdline_file.read()
+
+        if cmdline:
+            args = cmdline.rstrip(b'\0').replace(b'\0', b' ')
+
+        else:
+            # kernel threads and zombies have no command line
+            name, state, __ = _proc_stat(pid)
+            if state == 'Z':
+                args = None
+            else:
+                args = f'[{name}]'.encode()
+
+    except OSError:
+        args = None
+
+    if args is None:
+        line = None
+    else:
+        line = pid.encode() + b' ' + args
+
+    return line
+
+def _proc_stat(pid):
+    '''
+        Return (name, state, parent pid) from /proc/PID/stat.
+
+        Raises OSError if the process is gone.
+
+        >>> name, state, ppid = _proc_stat(os.getpid())
+        >>> ppid == os.getppid()
+        True
+    '''
+
+    with open(f'/proc/{pid}/stat', 'rb') as stat_file:
+        stat = stat_file.read().decode(errors='replace')
+
+    # the name is in parens, and can itself contain parens
+    name, __, fields = stat[stat.index('(') + 1:].rpartition(')')
+    # only split off the fields we need
+    state, ppid, __ = fields.split(maxsplit=2)
+
+    return name, state, int(ppid)
+
+@contextmanager
+def process_snapshot():
+    '''
+        Context manager to use one snapshot of the processes in /proc
+        for all zombies(), child_pids(), and pid_from_port() calls
+        in the block.
+
+        Without a snapshot, each call reads /proc again.
+
+        >>> with process_snapshot():
+        ...     zombies() == zombies()
+        True
+    '''
+
+    global pinned_snapshot, pinned_socket_pids
+
+    if pinned_snapshot is None:
+        pinned_snapshot = _proc_snapshot()
+        try:
+            yield
+        finally:
+            pinned_snapshot = None
+            pinned_socket_pids = None
+
+    else:
+        # an outer block already took a snapshot
+        yield
+
+def _proc_snapshot():
+    '''
+        Return {pid: (state, parent pid)} for every process.
+
+        Inside process_snapshot(), returns its snapshot.
+    '''
+
+    if pinned_snapshot is None:
+        snapshot = {}
+        with os.scandir('/proc') as entries:
+            for entry in entries:
+                if entry.name.isdigit():
+                    try:
+                        __, state, ppid = _proc_stat(entry.name)
+                    except OSError:
+                        # the process ended
+                        pass
+                    else:
+                        snapshot[int(entry.name)] = (state, ppid)
+
+    else:
+        snapshot = pinned_snapshot
+
+    return snapshot
+
 def wait(event, timeout=None, sleep_time=1, event_args=None, event_kwargs=None):
     ''' Wait for an event. Retries event until success or timeout.
 
@@ -450,21 +801,32 @@ def wait(event, timeout=None, sleep_time=1, event_args=None, event_kwargs=None):
         'event_kwargs' is an dict of keyword args to event(). Default is None.
 
         Returns result from event() if no timeout, or if timeout returns last exception.
+
+        >>> wait(lambda: 'done', timeout=0.5)
+        'done'
+        >>> def fail():
+        ...     raise ValueError('not yet')
+        >>> wait(fail, timeout=0.5, sleep_time=0.1)
+        Traceback (most recent call last):
+        ...
+        ValueError: not yet
     '''
 
     def timed_out():
-        return timeout and (now() >= deadline)
+        return timeout and (time.monotonic() >= deadline)
 
     if timeout:
 
-        if isinstance(timeout, int or float):
-            deadline = now() + datetime.timedelta(seconds=timeout)
+        # the deadline is in time.monotonic() seconds, which are cheaper
+        # than datetimes and don't jump when the clock is set
+        if isinstance(timeout, (int, float)):
+            deadline = time.monotonic() + timeout
 
         elif isinstance(timeout, datetime.timedelta):
-            deadline = now() + timeout
+            deadline = time.monotonic() + timeout.total_seconds()
 
         elif isinstance(timeout, datetime.datetime):
-            deadline = timeout
+            deadline = time.monotonic() + (timeout - now()).total_seconds()
 
         else:
             raise TypeError('timeout must be an int, float, datetime.timedelta, or datetime.datetime')
@@ -493,7 +855,7 @@ def wait(event, timeout=None, sleep_time=1, event_args=None, event_kwargs=None):
         else:
             success = True
 
-        if not timed_out():
+        if not success and not timed_out():
             time.sleep(sleep_time)
 
     return result
@@ -550,23 +912,62 @@ def zombies():
 
     pids = []
 
-    stdout = run('ps', '-A', '--format', 'stat,pid,ppid').stdout
-    for line in stdout.split('\n'):
-        stat, pid, ppid = line.split()
-        if 'Z' in stat.upper():
-            pids.append((pid, ppid))
+    for pid, (state, ppid) in _proc_snapshot().items():
+        if state == 'Z':
+            # strings, as when parsed from ps
+            pids.append((str(pid), str(ppid)))
 
     return pids
 
 def kill(pid):
-    ''' Kill pid. '''
+    ''' Kill pid.
+
+        Sends SIGTERM, then SIGHUP, then SIGKILL. After each signal, waits
+        up to KILL_WAIT_SECONDS for the process to exit before sending
+        the next, so the process has a chance to clean up.
+
+        >>> from solidlibs.os.command import background
+        >>> process = background('sleep', 10)
+        >>> kill(process.pid)
+        >>> process.wait() == -signal.SIGTERM
+        True
+    '''
 
     # it takes multiple signals to kill reliably
     for sig in [signal.SIGTERM, signal.SIGHUP, signal.SIGKILL]:
         try:
             os.kill(pid, sig)
         except Exception:
-            pass
+            # the process is gone, or we can't signal it
+            break
+
+        if sig != signal.SIGKILL and _wait_for_exit(pid, KILL_WAIT_SECONDS):
+            break
+
+def _wait_for_exit(pid, timeout):
+    ''' Wait up to timeout seconds for pid to exit.
+
+        Returns True if pid exited. A zombie has exited.
+    '''
+
+    def is_running():
+        try:
+            __, state, __ = _proc_stat(pid)
+        except OSError:
+            running = False
+        else:
+            running = state != 'Z'
+        return running
+
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    running = is_running()
+    while running and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.01)
+        running = is_running()
+
+    return not running
 
 def is_pid_active(pid):
     ''' Return True if pid is active. Else return False.
@@ -13,18 +13,27 @@
 '''
 
 import cProfile
+import os
 import pstats
 import time
+from functools import lru_cache
 from io import StringIO
 
 from solidlibs.python.log import Log
 
 log = Log()
 
-def run(command, datafile, global_vars=None, local_vars=None):
+# {datafile: ((st_mtime_ns, st_size), pstats.Stats)}, so more reports from the
+# same profile don't load the data again
+stats_cache = {}
+# most profiles kept in stats_cache; the oldest is dropped first
+max_cached_stats = 4
+
+def run(command, datafile, global_vars=None, local_vars=None,
+        command_args=None, command_kwargs=None, builtins=True):
     ''' Profile python code
 
-        'command' is python code as a string
+        'command' is python code as a string, or a function.
 
         'datafile' is the pathname to write profile data.
 
@@ -33,6 +42,17 @@ def run(command, datafile, global_vars=None, local_vars=None):
         should be called in place of:
             myprogram.main()
 
+        A string command is compiled once, no matter how many times
+        it is profiled.
+
+        If 'command' is a function, run() calls it with 'command_args' and
+        'command_kwargs', and returns its result. There's no code string
+        to compile. Example:
+            run(myprogram.main, '/tmp/main.profile')
+
+        If 'builtins' is False, calls to builtin functions are not
+        profiled. That makes profiling faster.
+
         WARNING: stdout and stderr of the function profiles may go in the bit bucket (why?)
                  If you suspect an error in your code, run it without cProfile.
 
@@ -46,26 +66,78 @@ def run(command, datafile, global_vars=None, local_vars=None):
         start
         end
         >>> assert os.path.getsize(DATA)
+
+        >>> os.remove(DATA)
+        >>> run(sum, DATA, command_args=[[1, 2, 3]], builtins=False)
+        6
+        >>> assert os.path.getsize(DATA)
     '''
 
     log.debug(f'run({repr(command)})')
 
-    if global_vars is None and local_vars is None:
-        cProfile.run(command, datafile)
-    else:
-        cProfile.runctx(command, global_vars, local_vars, filename=datafile, sort=-1)
+    if command_args is None:
+        command_args = []
+    if command_kwargs is None:
+        command_kwargs = {}
+
+    result = None
+    profile = cProfile.Profile(builtins=builtins)
+
+    try:
+        if callable(command):
+            profile.enable()
+            try:
+                result = command(*command_args, **command_kwargs)
+            finally:
+                profile.disable()
+
+        else:
+            if global_vars is None and local_vars is None:
+                # like cProfile.run()
+                import __main__
+                global_vars = local_vars = __main__.__dict__
+            elif global_vars is None:
+                global_vars = local_vars
+
+            code = _compile_command(command)
+            profile.enable()
+            try:
+                exec(code, global_vars, local_vars)
+            finally:
+                profile.disable()
+
+    except SystemExit:
+        # like cProfile.run(), still write the profile
+        pass
+
+    finally:
+        profile.dump_stats(datafile)
 
     log.debug('run() done')
 
-def report(datafile, lines=None):
+    return result
+
+@lru_cache(maxsize=128)
+def _compile_command(command):
+    ''' Compile a python code string once.
+
+        Only the most recently used code strings stay compiled.
+    '''
+
+    return compile(command, '<string>', 'exec')
+
+def report(datafile, lines=None, stream=None):
     ''' Report on profile data from datafile.
 
+        'datafile' is the pathname of profile data, or a pstats.Stats.
+
         Default lines to print is 20.
 
         If you need to profile before the program ends, set a timer to
         invoke report().
 
-        Returns report text.
+        Returns report text. If 'stream' is a file, the report is written
+        to the stream as it's formatted, and report() returns None.
 
         >>> import os, os.path
         >>>
@@ -85,31 +157,66 @@ def report(datafile, lines=None):
         ...     result = f.write(text)
         >>> os.path.getsize(REPORT) > 0
         True
+
+        >>> report(DATA, lines=5) == report(load_stats(DATA), lines=5)
+        True
+
+        >>> write_report(DATA, REPORT)
+        >>> with open(REPORT) as f:
+        ...     f.read() == text
+        True
     '''
 
     if not lines:
         lines = 20
 
-    out = StringIO()
-    stats = pstats.Stats(datafile, stream=out)
+    if isinstance(datafile, pstats.Stats):
+        stats = datafile
+    else:
+        stats = load_stats(datafile)
+
+    if stream is None:
+        out = StringIO()
+    else:
+        out = stream
+
+    stats.stream = out
     # stats.strip_dirs()
     stats.sort_stats('cumulative', 'time', 'calls')
     stats.print_stats(lines)
-    text = out.getvalue()
 
-    log.debug(f'report from {datafile}:\n{text}')
+    if stream is None:
+        text = out.getvalue()
+        log.debug(f'report from {datafile}:\n{text}')
+    else:
+        text = None
+        log.debug(f'report from {datafile} written to {stream}')
 
     return text
 
+def load_stats(datafile):
+    ''' Return pstats.Stats for datafile.
+
+        The stats are loaded once, and again only if datafile changes.
+        Only the stats for the last few datafiles are kept.
+    '''
+
+    statinfo = os.stat(datafile)
+    version = (statinfo.st_mtime_ns, statinfo.st_size)
+    if datafile in stats_cache and stats_cache[datafile][0] == version:
+        stats = stats_cache[datafile][1]
+    else:
+        stats = pstats.Stats(datafile)
+        stats_cache.pop(datafile, None)
+        if len(stats_cache) >= max_cached_stats:
+            del stats_cache[next(iter(stats_cache))]
+        stats_cache[datafile] = (version, stats)
+
+    return stats
+
 def report_to_file(codestring, reportfile, datafile=None, global_vars=None, local_vars=None):
     ''' Profile codestring and write report to reportfile. '''
 
-    def write_report():
-        text = report(datafile)
-        with open(reportfile, 'w') as f:
-            f.write(text)
-        log.debug(f'profile report is in {reportfile}')
-
     if datafile is None:
         datafile = reportfile + '.data'
 
@@ -117,18 +224,18 @@ def report_to_file(codestring, reportfile, datafile=None, global_vars=None, loca
         run(codestring, datafile, global_vars=global_vars, local_vars=local_vars)
     except:   # NOQA
         log.debug('always report profile')
-        write_report()
+        write_report(datafile, reportfile)
         raise
 
     else:
-        write_report()
+        write_report(datafile, reportfile)
 
 def write_report(datafile, reportfile):
     ''' Write report from datafile to reportfile. '''
 
-    text = report(datafile)
+    # write the report as it's formatted, without a copy in memory
     with open(reportfile, 'w') as f:
-        f.write(text)
+        report(datafile, stream=f)
     log.debug(f'profile report is in {reportfile}')
 
 def _sample_test_code():
@@ -8,9 +8,11 @@
 '''
 
 from contextlib import contextmanager
+from functools import lru_cache
 import grp
 import os
 import pwd
+import struct
 import sys
 
 from solidlibs.os.command import run
@@ -19,33 +21,42 @@ from solidlibs.python.log import Log
 
 log = Log()
 
+# {euid: user name} for whoami()
+whoami_names = {}
+
+# glibc struct utmp on Linux
+UTMP_PATH = '/var/run/utmp'
+UTMP_RECORD = struct.Struct('hi32s4s32s256shhiii4i20s')
+UTMP_USER_PROCESS = 7
+
 def whoami():
     ''' Get name of current user.
 
-        Calling whoami() via run() writes to /var/log/auth.log.
-        To avoid flooding that log, try to cache the result from
-        whoami() when you can.
+        The name is looked up directly instead of running the
+        whoami program, which writes to /var/log/auth.log.
+        Names are cached by euid, so after su() or sudo() changes
+        the euid we still return the right user.
 
         >>> assert whoami() == run('whoami').stdout
         >>> assert whoami() == pwd.getpwuid(os.geteuid()).pw_name
     '''
 
-    """
-        Two methods, each of which is noisy in a different way.
-        Calling getuid_name(os.geteuid()) adds systemd-hostnamed
-        entries in syslog.
-        Calling run('whoami').stdout adds noise to solidlibs.os.command.log
-        and master.log.
-    """
+    euid = os.geteuid()
+    who = whoami_names.get(euid)
+    if who is None:
+        who = pwd.getpwuid(euid).pw_name
+        whoami_names[euid] = who
 
-    # who = getuid_name(os.geteuid())
-    who = run('whoami').stdout
     return who
 
-def require_user(user):
-    ''' Require a specific current user. '''
+def require_user(user, current_user=None):
+    ''' Require a specific current user.
 
-    current_user = whoami()
+        If you already know the current user, pass it as current_user.
+    '''
+
+    if current_user is None:
+        current_user = whoami()
     if current_user != user:
         # import this late to avoid conflicts
         from solidlibs.python.utils import stacktrace
@@ -75,7 +86,8 @@ def su(newuser, set_home_dir=True):
         Raises OsError if user does not exist or current
         user does not has permission to log in as new user. '''
 
-    if whoami() != newuser:
+    current_user = whoami()
+    if current_user != newuser:
         uid = getuid(newuser)
         os.seteuid(uid)
         # why doesn't this work?
@@ -85,12 +97,15 @@ def su(newuser, set_home_dir=True):
             #     os._exit(0)
 
             os.setuid(uid)
-        except:   # pylint:bare-except -- catches more than "except Exception"
+        except PermissionError:
             # print(traceback.format_exc().strip()) # DEBUG
             # print('ERROR IGNORED. Because os.setuid() does not appear to work even for root') # DEBUG
             pass
 
-    require_user(newuser)
+        # we changed the euid, so check the new user
+        current_user = None
+
+    require_user(newuser, current_user=current_user)
     if set_home_dir:
         os.environ['HOME'] = getdir(newuser)
 
@@ -159,25 +174,29 @@ def sudo(username=None, set_home_dir=True):
             os.waitpid(child, 0)
 
         """
+        # look up both users before we change the euid, usually from the caches
+        uid = getuid(username)
+        prev_uid = getuid(prev_user)
+        if set_home_dir:
+            home_dir = _getdir(username)
+            prev_home_dir = _getdir(prev_user)
         try:
-            uid = getuid(username)
             if prev_user == 'root':
                 os.seteuid(uid)
             else:
                 os.setuid(uid)
             # os.setuid(uid) # DEBUG
             if set_home_dir:
-                os.environ['HOME'] = getdir(username)
+                os.environ['HOME'] = home_dir
             yield
         finally:
-            prev_uid = getuid(prev_user)
             try:
                 os.seteuid(prev_uid)
-            except:   # pylint:bare-except -- catches more than "except Exception"
+            except PermissionError:
                 pass
             else:
                 if set_home_dir:
-                    os.environ['HOME'] = getdir(prev_user)
+                    os.environ['HOME'] = prev_home_dir
 
     if not username:
         username = 'root'
@@ -236,10 +255,38 @@ def users():
 
     '''
 
-    return set(run('users').stdout.split())
+    try:
+        active_users = _utmp_users(UTMP_PATH)
+    except (OSError, struct.error):
+        active_users = set(run('users').stdout.split())
+
+    return active_users
 
+def _utmp_users(path):
+    ''' Return the set of user names logged in according to utmp file path. '''
+
+    active_users = set()
+    with open(path, 'rb') as utmp_file:
+        data = utmp_file.read()
+
+    record_count = len(data) // UTMP_RECORD.size
+    for fields in UTMP_RECORD.iter_unpack(data[:record_count * UTMP_RECORD.size]):
+        ut_type = fields[0]
+        ut_user = fields[4].split(b'\0', 1)[0]
+        if ut_type == UTMP_USER_PROCESS and ut_user:
+            active_users.add(ut_user.decode(errors='replace'))
+
+    return active_users
+
+@lru_cache(maxsize=256)
 def getuid(username):
-    ''' Return uid for username. '''
+    ''' Return uid for username.
+
+        Results are cached. See clear_user_caches().
+
+        >>> getuid('root')
+        0
+    '''
 
     name_info = pwd.getpwnam(username)
     return name_info.pw_uid
@@ -254,8 +301,16 @@ def getuid_name(uid):
             ...
         ValueError: uid is not an int: not an int
 
+        >>> getuid_name(987654)
+        Traceback (most recent call last):
+            ...
+        ValueError: Not a valid uid 987654
+
         >>> for entry in pwd.getpwall():
         ...     assert getuid_name(entry.pw_uid) == entry.pw_name
+
+        >>> getuid_name(os.geteuid()) == whoami()
+        True
     '''
 
     try:
@@ -263,18 +318,26 @@ def getuid_name(uid):
     except ValueError:
         raise ValueError(f'uid is not an int: {uid}')
 
-    name = None
-    for entry in pwd.getpwall():
-        if entry.pw_uid == uid:
-            name = entry.pw_name
-
-    if name is None:
-        raise ValueError(f'Not a valid uid {uid}')
+    if uid == os.geteuid():
+        # usually cached
+        name = whoami()
+    else:
+        try:
+            name = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            raise ValueError(f'Not a valid uid {uid}')
 
     return name
 
+@lru_cache(maxsize=256)
 def getgid(groupname):
-    ''' Return gid for groupname. '''
+    ''' Return gid for groupname.
+
+        Results are cached. See clear_user_caches().
+
+        >>> getgid('root')
+        0
+    '''
 
     name_info = grp.getgrnam(groupname)
     return name_info.gr_gid
@@ -289,6 +352,11 @@ def getgid_name(gid):
             ...
         ValueError: gid is not an int: string
 
+        >>> getgid_name(987654)
+        Traceback (most recent call last):
+            ...
+        ValueError: Not a valid gid 987654
+
         >>> for entry in grp.getgrall():
         ...     assert getgid_name(entry.gr_gid) == entry.gr_name
     '''
@@ -298,25 +366,52 @@ def getgid_name(gid):
     except ValueError:
         raise ValueError(f'gid is not an int: {gid}')
 
-    name = None
-    for entry in grp.getgrall():
-        if entry.gr_gid == gid:
-            name = entry.gr_name
-
-    if name is None:
+    try:
+        name = grp.getgrgid(gid).gr_name
+    except KeyError:
         raise ValueError(f'Not a valid gid {gid}')
 
     return name
 
 def getdir(username=None):
-    ''' Return home dir for username. '''
+    ''' Return home dir for username.
+
+        The default is the current user.
+        Results are cached. See clear_user_caches().
+
+        >>> getdir('root')
+        '/root'
+    '''
 
     if username is None:
         username = whoami()
 
+    return _getdir(username)
+
+@lru_cache(maxsize=256)
+def _getdir(username):
+    ''' Return home dir for username. '''
+
     name_info = pwd.getpwnam(username)
     return name_info.pw_dir
 
+def clear_user_caches():
+    ''' Forget cached user and group info.
+
+        Changing the euid doesn't make the caches stale, because
+        they are keyed by euid, user name, or group name.
+        Call this after adding, changing, or removing users or groups.
+
+        >>> clear_user_caches()
+        >>> getuid('root')
+        0
+    '''
+
+    whoami_names.clear()
+    getuid.cache_clear()
+    getgid.cache_clear()
+    _getdir.cache_clear()
+
 def sudo_with_path(user, path, *command):
     ''' Run command as user using PATH=path.
 
@@ -343,9 +438,12 @@ def sudo_with_path_args(user, path, *command):
         This breaks virtualenv, for example.
 
         The -E switch in sudo is nearly useless.
+
+        >>> sudo_with_path_args('nobody', '/usr/bin:/bin', 'ls', '-l')
+        ['sudo', '-u', 'nobody', 'PATH=/usr/bin:/bin', 'ls', '-l']
     '''
 
-    return ['sudo', '-u', user, f'PATH={path}'] + list(command)
+    return ['sudo', '-u', user, f'PATH={path}', *command]
 
 
 if __name__ == "__main__":
@@ -17,25 +17,61 @@
 
 import os
 import pwd
+import sys
+import threading
 import time
 from tempfile import gettempdir
 from traceback import format_exc
 
+# {filename: binary log file}, kept open between calls
+logfiles = {}
+# most log files kept open at once; the oldest is closed first
+max_logfiles = 16
+# held while we open, close, or write log files, so one thread
+# doesn't close a log file another thread is writing
+logfiles_lock = threading.Lock()
+
+# {euid: default log filename}
+default_filenames = {}
+
+# second and formatted time last used by timestamp()
+timestamp_second = None
+formatted_timestamp_second = None
+
 def log(message, filename=None, mode=None):
-    ''' Log message that solidlibs.python.log can't. '''
+    ''' Log message that solidlibs.python.log can't.
+
+        Log files stay open and are unbuffered, so every message
+        is written when log() returns. Each message is encoded as
+        UTF-8 and written with a single write.
+
+        The mode, e.g. '0666', is used when the log file is created.
+
+        If the log file is deleted or replaced, it is reopened.
+        log() is thread safe.
+
+        >>> import tempfile
+        >>> logdir = tempfile.mkdtemp()
+        >>> filename = os.path.join(logdir, 'test.log')
+        >>> log('first', filename=filename, mode='0600')
+        >>> oct(os.stat(filename).st_mode & 0o777)
+        '0o600'
+        >>> os.remove(filename)
+        >>> log('second', filename=filename)
+        >>> with open(filename) as logfile:
+        ...     logfile.read().endswith(' second\\n')
+        True
+        >>> logfiles.pop(filename).close()
+        >>> os.remove(filename)
+        >>> os.rmdir(logdir)
+    '''
 
     if filename is None:
-        try:
-            user = whoami()
-        # we want to catch any type of exception and Exception won't always do that
-        except:   # pylint:bare-except -- catches more than "except Exception"
-            user = 'unknown'
-        filename = os.path.join(gettempdir(), f'_log.{user}.log')
-    if mode is None:
-        mode = '0666'
+        filename = default_filename()
 
-    with open(filename, 'a') as logfile:
-        current_timestamp = timestamp()
+    current_timestamp = timestamp()
+    with logfiles_lock:
+        logfile = _open_logfile(filename, mode)
         try:
             # logwriter dies sometimes and stops regular logging
             # but logit itself logs to this alternate log
@@ -43,20 +79,81 @@ def log(message, filename=None, mode=None):
             #    journalctl --unit logit
             # error is e.g.:
             #    2020-04-17 19:21:33,555 too many values to unpack (expected 3)
-            logfile.write(f'{current_timestamp} {format_exc()}\n') # DEBUG
-            logfile.write(f'{current_timestamp} {message}\n')
+            text = f'{current_timestamp} {message}\n'
+            if sys.exc_info()[0] is not None:
+                text = f'{current_timestamp} {format_exc()}\n{text}'
+            logfile.write(text.encode(errors='replace'))
         except UnicodeDecodeError:
             from solidlibs.python.utils import is_string
 
             try:
-                logfile.write(f'unable to write message because it is a type: {type(message)}')
+                logfile.write(f'unable to write message because it is a type: {type(message)}'.encode())
                 if not is_string(message):
                     decoded_message = message.decode(errors='replace')
-                    logfile.write(f'{current_timestamp} {decoded_message}\n')
+                    logfile.write(f'{current_timestamp} {decoded_message}\n'.encode(errors='replace'))
 
             except:  # pylint:bare-except -- catches more than "except Exception"
                 print(format_exc())
 
+def default_filename():
+    ''' Return the default log filename for the current user.
+
+        >>> default_filename() == os.path.join(gettempdir(), f'_log.{whoami()}.log')
+        True
+    '''
+
+    euid = os.geteuid()
+    filename = default_filenames.get(euid)
+    if filename is None:
+        try:
+            user = whoami()
+        # we want to catch any type of exception and Exception won't always do that
+        except:   # pylint:bare-except -- catches more than "except Exception"
+            user = 'unknown'
+        filename = os.path.join(gettempdir(), f'_log.{user}.log')
+        default_filenames[euid] = filename
+
+    return filename
+
+def _open_logfile(filename, mode=None):
+    ''' Return an open, unbuffered binary log file for filename.
+
+        A cached log file is reopened if filename no longer
+        refers to it, e.g. after the file was deleted.
+
+        The caller must hold logfiles_lock.
+    '''
+
+    logfile = logfiles.get(filename)
+    if logfile is not None and not (logfile.closed or _is_current(logfile, filename)):
+        logfile.close()
+
+    if logfile is None or logfile.closed:
+        logfiles.pop(filename, None)
+        if len(logfiles) >= max_logfiles:
+            oldest = next(iter(logfiles))
+            logfiles.pop(oldest).close()
+
+        if mode is None:
+            mode = '0666'
+        if isinstance(mode, str):
+            mode = int(mode, 8)
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, mode)
+        logfile = open(fd, 'ab', buffering=0)
+        logfiles[filename] = logfile
+
+    return logfile
+
+def _is_current(logfile, filename):
+    ''' Return True if filename is still the file logfile has open. '''
+
+    try:
+        path_stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+
+    file_stat = os.fstat(logfile.fileno())
+    return (path_stat.st_dev, path_stat.st_ino) == (file_stat.st_dev, file_stat.st_ino)
 
 # redir log.debug() etc.
 log.debug = log
@@ -71,10 +168,21 @@ def whoami():
 
 def timestamp():
     ''' Timestamp as a string. Duplicated in this module to avoid recursive
-        imports. '''
+        imports.
+
+        The formatted date and time is reused within the same second.
+
+        >>> import re
+        >>> re.fullmatch(r'\\d{4}-\\d\\d-\\d\\d \\d\\d:\\d\\d:\\d\\d,\\d{3}', timestamp()) is not None
+        True
+    '''
+
+    global timestamp_second, formatted_timestamp_second
 
     current_time = time.time()
-    milliseconds = int((current_time - int(current_time)) * 1000)
-    formatted_current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    formatted_milliseconds = '{:03}'.format(milliseconds)
-    return f'{formatted_current_time},{formatted_milliseconds}'
+    current_second = int(current_time)
+    if current_second != timestamp_second:
+        formatted_timestamp_second = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(current_second))
+        timestamp_second = current_second
+    milliseconds = int((current_time - current_second) * 1000)
+    return f'{formatted_timestamp_second},{milliseconds:03}'
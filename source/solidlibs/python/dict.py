@@ -40,6 +40,7 @@
 import datetime
 import json
 import types
+import weakref
 from collections.abc import Mapping
 
 from solidlibs.python.internals import is_class_instance
@@ -51,6 +52,27 @@ log = Log()
 _unimplemented_types = set()
 datetime_types = (datetime.timedelta, datetime.date, datetime.datetime, datetime.time, datetime.timezone)
 
+allowed_types = (
+        type(None),
+        bool,
+        int, int, float, complex,
+        # ?? StringTypes is itself a tuple; can we nest it like this?
+        str,
+        tuple, list, dict,
+        object,
+        # types.MethodType, types.FunctionType,
+        # types.ModuleType,
+        # types.GeneratorType,
+        ) + datetime_types
+
+# {type: how dictify() resolves that type}, filled in as types are seen
+# weak keys, so classes that go away, e.g. ones made at runtime, are dropped
+resolve_kinds = weakref.WeakKeyDictionary()
+# dict key types that dictify() keeps as is, and that json accepts
+plain_key_types = (str, int, float, bool, type(None))
+# kinds with no nested objects for dictify() to resolve
+leaf_kinds = {'string', 'datetime', 'tzinfo', 'module', 'allowed', 'unimplemented'}
+
 class Simple(dict):
     ''' You can reference a field in a Simple object by either obj.name or
         obj['name']. It's ideal for going to and from json, or when you need to iterate through fields.
@@ -188,15 +210,15 @@ class Simple(dict):
     '''
 
     def __getattr__(self, name):
-        if name in self:
+        # one dict lookup instead of "in" and then []
+        try:
             value = self[name]
-        else:
-            raise AttributeError(name)
+        except KeyError:
+            raise AttributeError(name) from None
         return value
 
     def __setattr__(self, name, value):
-        if isinstance(name, dict):
-            name = Simple(name)
+        # attribute names are always str, so only the value may be a dict
         if isinstance(value, dict):
             value = Simple(value)
         self[name] = value
@@ -233,6 +255,16 @@ class CaseInsensitiveDict(Mapping):
         Dict lookups ignore key case. The key matches in lower, upper, or mixed case.
 
         Mostly from http://stackoverflow.com/questions/3296499/case-insensitive-dictionary-search-with-python
+
+        >>> headers = CaseInsensitiveDict({'Content-Type': 'text/plain'})
+        >>> headers['content-type']
+        'text/plain'
+        >>> headers['CONTENT-TYPE'] = 'text/html'
+        >>> str(headers)
+        'CONTENT-TYPE: text/html'
+        >>> del headers['Content-type']
+        >>> len(headers)
+        0
     '''
 
     def __init__(self, d=None):
@@ -255,12 +287,16 @@ class CaseInsensitiveDict(Mapping):
         return self._d[self._s[k.lower()]]
 
     def __setitem__(self, k, v):
+        lower_k = k.lower()
+        old_k = self._s.get(lower_k)
+        if old_k is not None and old_k != k:
+            # don't leave the old case of this key behind
+            del self._d[old_k]
         self._d[k] = v
-        self._s[k.lower()] = k
+        self._s[lower_k] = k
 
     def __delitem__(self, k):
-        del self._d[self._s[k.lower()]]
-        del self._s[k.lower()]
+        del self._d[self._s.pop(k.lower())]
 
     def __str__(self):
         strings = []
@@ -434,20 +470,30 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
         >>> d = dictify(timing_access_line)
         >>> isinstance(d, Simple)
         True
-    '''
 
-    allowed_types = (
-            type(None),
-            bool,
-            int, int, float, complex,
-            # ?? StringTypes is itself a tuple; can we nest it like this?
-            str,
-            tuple, list, dict,
-            object,
-            # types.MethodType, types.FunctionType,
-            # types.ModuleType,
-            # types.GeneratorType,
-            ) + datetime_types
+        >>> dictify({(1, 2): 'tuple key', None: 'none key'}, json_compatible=True)
+        {'(1, 2)': 'tuple key', None: 'none key'}
+
+        An object that appears more than once is resolved once.
+
+        A shared object is resolved once, and each reference to it
+        gets its own copy of the resolved value.
+
+        >>> shared = {'a': 1}
+        >>> d = dictify({'x': shared, 'y': [shared]})
+        >>> d['x'] == d['y'][0]
+        True
+        >>> d['x'] is d['y'][0]
+        False
+        >>> d['x']['a'] = 2
+        >>> d['y'][0]['a']
+        1
+
+        >>> loop = [1]
+        >>> loop.append(loop)
+        >>> dictify(loop)
+        [1, "__syr.dict.dictify: circular_reference to [1, [...]], type <class 'list'>__"]
+    '''
 
     def type_allowed(obj):
         return isinstance(obj, allowed_types)
@@ -462,12 +508,12 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
         if not isinstance(obj, datetime_types):
 
             obj_id = id(obj)
-            if obj_id in obj_ids:
+            if obj_id in in_progress:
                 obj = f'__syr.dict.dictify: circular_reference to {repr(obj)}, type {type(obj)}__'
                 if debug: log.warning(obj)
 
             else:
-                obj_ids.add(obj_id)
+                in_progress.add(obj_id)
 
         return obj
 
@@ -477,10 +523,16 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
             Starting with python 2.6 all strings are unicode.
             But for readability we use a plain string where possible. '''
 
-        try:
-            value = str(obj)
-        except (Exception, AttributeError, IOError, OSError):
-            value = f'{obj}'
+        if type(obj) is str:
+            # already a plain string
+            value = obj
+
+        else:
+            # a str subclass may have its own __str__
+            try:
+                value = str(obj)
+            except (Exception, AttributeError, IOError, OSError):
+                value = f'{obj}'
 
         return value
 
@@ -523,24 +575,32 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
         return value
 
     def resolve_dict(obj, json_compatible=False):
-        ''' Resolve a simple dict object. This is a deep resolve to a Simple. '''
+        ''' Resolve a simple dict object. This is a deep resolve to a Simple.
 
-        d = Simple({})
+            Like resolve_obj(), this is a generator. See resolve().
+        '''
+
+        d = Simple()
         for key in obj:
 
-            # a dictionary needs a hashable key
-            try:
-                new_key = resolve_obj(key)
-                hash(new_key)
-            except (Exception, AttributeError, IOError, OSError):
-                new_key = f'{type(key)}-{id(key)}'
+            if type(key) in plain_key_types:
+                # most keys resolve to themselves and are json compatible
+                new_key = key
+
+            else:
+                # a dictionary needs a hashable key
+                try:
+                    new_key = yield key
+                    hash(new_key)
+                except (Exception, AttributeError, IOError, OSError):
+                    new_key = f'{type(key)}-{id(key)}'
 
-            if json_compatible:
-                # convert key to a json compatible type
-                if not isinstance(new_key, (str, int, float, bool, None)):
-                    new_key = repr(new_key)
+                if json_compatible:
+                    # convert key to a json compatible type
+                    if not isinstance(new_key, plain_key_types):
+                        new_key = repr(new_key)
 
-            new_value = resolve_obj(obj[key])
+            new_value = yield obj[key]
 
             try:
                 d[new_key] = new_value
@@ -557,14 +617,17 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
         return d
 
     def resolve_instance(obj):
-        ''' Resolve an instance of a class. '''
+        ''' Resolve an instance of a class.
+
+            Like resolve_obj(), this is a generator. See resolve().
+        '''
 
-        d = Simple({})
+        d = Simple()
 
         # call the obj an instance for clarity here
         instance = obj
         # get names of instance attributes
-        for name in dir(instance):
+        for name in attribute_names(instance):
             # ignore builtins, etc.
             if not name.startswith('__'):
 
@@ -599,7 +662,7 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
                         else:
                             if debug: log('member {}.{} is an allowed type ({}) so resolving object'.
                                               format(name, repr(attr), type(attr)))
-                            d[name] = resolve_obj(attr)
+                            d[name] = yield attr
 
                     else:
                         if debug: log.warning(f'in resolve_obj() type not allowed ({attr!r}), so skipping')
@@ -620,15 +683,60 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
     def resolve_module(module):
         ''' Resolve a module to a dict object. '''
 
-        d = Simple({})
+        d = Simple()
         for k, v in list(module.__dict__.items()):
             if not k.startswith('__'):
                 d[k] = v
 
         return d
 
+    def resolve_leaf(obj, kind):
+        ''' Resolve an obj of a kind that has no nested objects to resolve.
+
+            Leaves can't be part of a circular reference, so resolve()
+            calls this directly instead of starting a resolve_obj().
+        '''
+
+        if kind == 'string':
+            value = resolve_string(obj)
+
+        elif kind == 'datetime':
+
+            value = resolve_datetime(obj)
+
+        elif kind == 'tzinfo':
+
+            # obviously wrong for some systems, but not ours
+            value = None
+
+        elif kind == 'module':
+
+            value = resolve_module(obj)
+            if debug: log(f'resolve_obj({obj}) value is module: {value!r}')
+
+        elif kind == 'allowed':
+
+            value = obj
+            if debug: log(f'resolve_obj({obj}) value is allowed type: {type(obj)}')
+
+        else:
+
+            # any other type as just the type, not restorable
+            value = str(type(obj))
+            if value not in _unimplemented_types:
+                # mention each type just once
+                _unimplemented_types.add(value)
+                if debug: log.warning(f'resolve_obj({obj}) value is unimplemented type: {value}')
+
+        return value
+
     def resolve_obj(obj):
-        ''' Resolve any type to a dict object. '''
+        ''' Resolve any type to a dict object.
+
+            This is a generator. It yields each nested object it needs
+            resolved, and resolve() sends back the resolved value.
+            The generator's return value is the resolved obj.
+        '''
 
         #assert not debug #DEBUG
         # usually commented out - set debug locally to test special case
@@ -640,83 +748,264 @@ def dictify(obj, deep=False, json_compatible=False, debug=False):
         if debug: log(f'resolve_obj({obj}) type {type(obj)}')
         obj = check_circular_reference(obj)
 
-        if isinstance(obj, str):
-            value = resolve_string(obj)
+        kind = resolve_kind(obj)
 
-        elif isinstance(obj, (tuple, types.GeneratorType)):
+        if kind == 'tuple':
 
             # immutable iterators
-            value = tuple(resolve_obj(item) for item in obj)
+            items = []
+            for item in obj:
+                items.append((yield item))
+            value = tuple(items)
             if debug: log(f'resolve_obj({obj}) value is tuple: {value!r}')
 
-        elif isinstance(obj, list):
+        elif kind == 'list':
 
             # mutable iterator
-            value = list(resolve_obj(item) for item in obj)
+            value = []
+            for item in obj:
+                value.append((yield item))
             if debug: log(f'resolve_obj({obj}) value is list: {value!r}')
 
-        elif isinstance(obj, dict):
+        elif kind == 'dict':
 
-            value = resolve_dict(obj, json_compatible=json_compatible)
+            value = yield from resolve_dict(obj, json_compatible=json_compatible)
             if debug: log(f'resolve_obj({obj}) value is dict: {value!r}')
 
-        elif isinstance(obj, datetime_types):
-
-            value = resolve_datetime(obj)
-
-        elif isinstance(obj, datetime.tzinfo):
+        elif kind == 'instance':
 
-            # obviously wrong for some systems, but not ours
-            value = None
-
-        elif is_class_instance(obj):
-
-            value = resolve_instance(obj)
+            value = yield from resolve_instance(obj)
             if debug: log(f'resolve_obj({obj}) value is instance: {value!r}')
 
-        elif isinstance(obj, types.ModuleType):
+        else:
+            value = resolve_leaf(obj, kind)
 
-            value = resolve_module(obj)
-            if debug: log(f'resolve_obj({obj}) value is module: {value!r}')
+        if debug: log(f'resolve_obj({obj}) final type: {type(value)}, value: {value!r}')
+        assert not isinstance(value, datetime_types) #DEBUG
 
-        elif type_allowed(obj):
+        # remove the object from circular reference check
+        if id(obj) in in_progress:
+            in_progress.remove(id(obj))
+            # keep obj so its id can't be reused while we run
+            completed[id(obj)] = (obj, value)
 
-            value = obj
-            if debug: log(f'resolve_obj({obj}) value is allowed type: {type(obj)}')
+        return value
 
-        else:
+    def resolve(obj):
+        ''' Resolve obj without recursion.
 
-            # any other type as just the type, not restorable
-            value = str(type(obj))
-            if value not in _unimplemented_types:
-                # mention each type just once
-                _unimplemented_types.add(value)
-                if debug: log.warning(f'resolve_obj({obj}) value is unimplemented type: {value}')
+            Each resolve_obj() generator yields the nested objects it
+            needs, and we resolve them with a new resolve_obj() on our
+            own stack. Deep structures don't hit python's recursion limit.
+        '''
 
-        if debug: log(f'resolve_obj({obj}) final type: {type(value)}, value: {value!r}')
-        assert not isinstance(value, datetime_types) #DEBUG
+        pending = []
+        resolver = resolve_obj(obj)
+        value = None
+        error = None
+        while resolver is not None:
+            try:
+                if error is None:
+                    nested_obj = resolver.send(value)
+                else:
+                    # pass the exception to the resolver that wanted the value
+                    nested_obj = resolver.throw(error)
+
+            except StopIteration as stop:
+                value = stop.value
+                error = None
+                resolver = pending.pop() if pending else None
+
+            except Exception as exc:
+                if not pending:
+                    raise
+                value = None
+                error = exc
+                resolver = pending.pop()
 
-        # remove the object from circular reference check
-        if id(obj) in obj_ids:
-            obj_ids.remove(id(obj))
+            else:
+                kind = resolve_kind(nested_obj)
+                if kind in leaf_kinds:
+                    # nothing nested, so no need for a generator
+                    value = resolve_leaf(nested_obj, kind)
+                elif id(nested_obj) in completed:
+                    # shared objects are resolved once, but callers
+                    # may change the result, so each use gets a copy
+                    __, value = completed[id(nested_obj)]
+                    value = _copy_resolved(value)
+                else:
+                    pending.append(resolver)
+                    resolver = resolve_obj(nested_obj)
+                    value = None
+                error = None
 
         return value
 
     debug = debug
 
     if debug: log(f'dictify({obj})')
-    obj_ids = set()
+    # ids of objects we are resolving, to catch circular references
+    in_progress = set()
+    # {id: (obj, value)} of objects already resolved
+    completed = {}
 
-    value = resolve_obj(obj)
+    value = resolve(obj)
 
     # if debug: log('dictify(%s) is %r' % (object_name(obj, include_repr=True), value))
     return value
 
+def _copy_resolved(value):
+    ''' Return a copy of a value resolved by dictify().
+
+        Only the containers dictify() makes are copied. Other values
+        are shared. Like dictify(), this doesn't recurse, so deep
+        values don't hit python's recursion limit.
+
+        >>> value = Simple(a=[1, (2, Simple(b=3))])
+        >>> copied = _copy_resolved(value)
+        >>> copied == value
+        True
+        >>> copied['a'][1][1] is value['a'][1][1]
+        False
+    '''
+
+    container_types = (Simple, list, tuple)
+    if type(value) not in container_types:
+        return value
+
+    # parents come before their children
+    containers = []
+    pending = [value]
+    while pending:
+        container = pending.pop()
+        containers.append(container)
+        items = container.values() if isinstance(container, dict) else container
+        pending.extend(item for item in items if type(item) in container_types)
+
+    # {id(container): copy}, children copied before their parents
+    copies = {}
+    for container in reversed(containers):
+        if isinstance(container, dict):
+            copied = Simple()
+            for key, item in container.items():
+                copied[key] = copies.get(id(item), item)
+        else:
+            copied = type(container)(copies.get(id(item), item) for item in container)
+        copies[id(container)] = copied
+
+    return copies[id(value)]
+
+def resolve_kind(obj):
+    ''' Return how dictify() resolves obj.
+
+        The answer depends only on the type of obj, so it is
+        cached by type. That replaces a chain of isinstance()
+        and is_class_instance() calls with one dict lookup.
+
+        >>> resolve_kind('text')
+        'string'
+        >>> resolve_kind((x for x in range(3)))
+        'tuple'
+        >>> resolve_kind(Simple())
+        'dict'
+        >>> resolve_kind(datetime.date(2000, 1, 2))
+        'datetime'
+        >>> resolve_kind(3)
+        'allowed'
+
+        >>> class Temporary:
+        ...     pass
+        >>> resolve_kind(Temporary())
+        'instance'
+        >>> del Temporary
+        >>> import gc
+        >>> __ = gc.collect()
+        >>> any(obj_type.__name__ == 'Temporary' for obj_type in resolve_kinds)
+        False
+    '''
+
+    obj_type = type(obj)
+    kind = resolve_kinds.get(obj_type)
+    if kind is None:
+
+        if isinstance(obj, str):
+            kind = 'string'
+        elif isinstance(obj, (tuple, types.GeneratorType)):
+            kind = 'tuple'
+        elif isinstance(obj, list):
+            kind = 'list'
+        elif isinstance(obj, dict):
+            kind = 'dict'
+        elif isinstance(obj, datetime_types):
+            kind = 'datetime'
+        elif isinstance(obj, datetime.tzinfo):
+            kind = 'tzinfo'
+        elif is_class_instance(obj):
+            kind = 'instance'
+        elif isinstance(obj, types.ModuleType):
+            kind = 'module'
+        elif isinstance(obj, allowed_types):
+            kind = 'allowed'
+        else:
+            kind = 'unimplemented'
+
+        resolve_kinds[obj_type] = kind
+
+    return kind
+
+def attribute_names(instance):
+    ''' Return the same names as dir(instance).
+
+        Unless the class customizes dir(), we collect the names from
+        the instance and class dicts directly, which is faster.
+
+        >>> class Example:
+        ...     class_data = 1
+        ...     def __init__(self):
+        ...         self.instance_data = 2
+        >>> example = Example()
+        >>> attribute_names(example) == dir(example)
+        True
+    '''
+
+    instance_type = type(instance)
+    if (instance_type.__dir__ is object.__dir__ and
+        getattr(instance, '__class__', None) is instance_type):
+
+        names = set(getattr(instance, '__dict__', ()))
+        for cls in instance_type.__mro__:
+            names.update(cls.__dict__)
+        names = sorted(names)
+
+    else:
+        names = dir(instance)
+
+    return names
+
 def force_json(obj, debug=False):
-    ''' Return json for the object, dropping fields as needed. '''
+    ''' Return json for the object, dropping fields as needed.
+
+        Only the parts of obj that json can't handle are dictified.
+
+        >>> class Example:
+        ...     def __init__(self):
+        ...         self.when = datetime.date(2000, 1, 2)
+        >>> force_json({'example': Example(), 'count': 1})
+        '{"example": {"when": {"year": 2000, "month": 1, "day": 2}}, "count": 1}'
+    '''
+
+    def dictify_default(unknown_obj):
+        ''' Dictify an object json.dumps() can't serialize. '''
+
+        value = dictify(unknown_obj, debug=debug)
+        if type(value) is type(unknown_obj):
+            # dictify() couldn't convert it either
+            raise TypeError(f'Object of type {type(unknown_obj).__name__} is not JSON serializable')
+
+        return value
 
     try:
-        json_out = json.dumps(obj)
+        json_out = json.dumps(obj, default=dictify_default)
     except TypeError as t_error:
         t_error_str = str(t_error)
         log(t_error_str)
@@ -9,11 +9,15 @@
     Consider moving these classes to times module.
 '''
 
-from solidlibs.python.times import now
+from datetime import datetime, timedelta, timezone
+from time import perf_counter_ns, time
 
 class ElapsedTime():
     ''' Context manager to compute elapsed time.
 
+        Elapsed time is measured with time.perf_counter_ns(), which is
+        cheaper and more precise than subtracting datetimes.
+
         >>> from time import sleep
         >>> from solidlibs.python.times import timedelta
         >>> ms = 200
@@ -24,17 +28,23 @@ class ElapsedTime():
         >>> upper_limit = timedelta(milliseconds=ms+1)
         >>> assert delta > lower_limit
         >>> assert delta <= upper_limit
+        >>> et.end > et.start
+        True
     '''
 
     def __init__(self):
-        self.start = now()
-        self.end = None
+        # wall clock for start and end, perf counter for elapsed time
+        self.start_seconds = time()
+        self.start_ns = perf_counter_ns()
+        self.end_seconds = None
+        self.end_ns = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc_info):
-        self.end = now()
+        self.end_ns = perf_counter_ns()
+        self.end_seconds = time()
 
     def __str__(self):
         try:
@@ -43,20 +53,36 @@ class ElapsedTime():
             return human_readable.precise_delta(self.timedelta())
         except ModuleNotFoundError:
 
-            return self.timedelta()
+            return str(self.timedelta())
+
+    @property
+    def start(self):
+        ''' Start time as a UTC datetime. '''
+
+        return datetime.fromtimestamp(self.start_seconds, tz=timezone.utc)
+
+    @property
+    def end(self):
+        ''' End time as a UTC datetime, or None if still in block. '''
+
+        if self.end_seconds is None:
+            result = None
+        else:
+            result = datetime.fromtimestamp(self.end_seconds, tz=timezone.utc)
+        return result
 
     def timedelta(self):
         ''' Elapsed time as timedelta type.
 
             If still in block, then elapsed time so far. '''
 
-        if self.end:
-            result = self.end - self.start
+        if self.end_ns is None:
+            end_ns = perf_counter_ns()
         else:
-            result = now() - self.start
-        return result
+            end_ns = self.end_ns
+        return timedelta(microseconds=(end_ns - self.start_ns) / 1000)
 
-class LogElapsedTime():
+class LogElapsedTime(ElapsedTime):
     ''' Context manager to log elapsed time.
 
         >>> from time import sleep
@@ -73,15 +99,13 @@ class LogElapsedTime():
         if not hasattr(log, 'debug'):
             raise ValueError(f"'log' must be a log, not {type(log)}")
 
-        self.start = now()
+        super().__init__()
         self.log = log
         self.msg = msg
 
-    def __enter__(self):
-        return self
-
     def __exit__(self, *exc_info):
-        elapsed = now() - self.start
+        super().__exit__(*exc_info)
+        elapsed = self.timedelta()
         if self.msg:
             self.log.debug(f'{self.msg} elapsed time {elapsed}')
         else:
@@ -118,7 +118,6 @@ import sys
 from tempfile import NamedTemporaryFile, gettempdir
 from traceback import format_exc, format_exception, format_exception_only, format_stack
 
-from solidlibs.os.command import run
 import solidlibs.python._log
 
 # constants shared with solidlibs.python.log and logwriter are
@@ -819,8 +818,8 @@ def clear_user_logs(user):
     '''
 
     logdir = os.path.join(BASE_LOG_DIR, user)
-    if os.listdir(logdir):
-        run('rm', f'{logdir}/*')
+    for path in glob(os.path.join(logdir, '*')):
+        os.remove(path)
 
     # if solidlibs.python.log.DEBUGGING is True, then solidlibs.python.log creates alt logs
     alt_log = f'/tmp/_log.{user}.log'